@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Tuple
+
+from conversation_utils import BotConfig
+from metrics import ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_SHED, ADMISSION_WAIT_SECONDS
+
+
+class Overloaded(Exception):
+    # Запрос отклонён без ожидания: очередь заполнена, ожидание слишком долгое или превышен лимит пользователя
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionController:
+    # Ограничивает число одновременных запросов к модели, длину очереди ожидания и частоту запросов пользователя
+    def __init__(self, config: BotConfig):
+        self._max_concurrent = config.max_concurrent_requests
+        self._max_queue = config.max_queued_requests
+        self._queue_timeout = config.queue_timeout
+        self._user_rate = config.user_rate_limit
+        self._user_period = config.user_rate_period
+        self._semaphore = asyncio.Semaphore(self._max_concurrent) if self._max_concurrent > 0 else None
+        # Корзина токенов на пользователя: (доступно запросов, время последнего пополнения).
+        # Корзины упорядочены по времени пополнения: самые давние в начале, поэтому очистка не требует полного обхода
+        self._buckets: OrderedDict[int, Tuple[float, float]] = OrderedDict()
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.admitted = 0
+        self.shed = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def _now(self) -> float:
+        return time.monotonic()
+
+    # Списывает один запрос из корзины пользователя; False, если лимит исчерпан
+    def _take_user_token(self, user_id: int) -> bool:
+        if self._user_rate <= 0 or self._user_period <= 0:
+            return True
+
+        now = self._now()
+        # Корзина, которую не трогали дольше периода, уже полна и ничем не отличается от отсутствующей.
+        # Такие корзины лежат в начале, поэтому просматриваем только их
+        expired = now - self._user_period
+        while self._buckets:
+            uid, (_, updated) = next(iter(self._buckets.items()))
+            if updated > expired:
+                break
+            del self._buckets[uid]
+
+        refill = self._user_rate / self._user_period
+        tokens, updated = self._buckets.pop(user_id, (float(self._user_rate), now))
+        tokens = min(float(self._user_rate), tokens + (now - updated) * refill)
+        if tokens < 1:
+            self._buckets[user_id] = (tokens, now)
+            return False
+
+        self._buckets[user_id] = (tokens - 1, now)
+        return True
+
+    # Ждёт освобождения слота в ограниченной очереди
+    async def _wait_for_slot(self) -> None:
+        if self.queue_depth >= self._max_queue:
+            self.shed += 1
+            ADMISSION_SHED.inc()
+            raise Overloaded("queue_full")
+
+        started = self._now()
+        self.queue_depth += 1
+        ADMISSION_QUEUE_DEPTH.inc()
+        try:
+            if self._queue_timeout > 0:
+                await asyncio.wait_for(self._semaphore.acquire(), self._queue_timeout)
+            else:
+                await self._semaphore.acquire()
+        except asyncio.TimeoutError:
+            self.shed += 1
+            ADMISSION_SHED.inc()
+            raise Overloaded("queue_timeout") from None
+        finally:
+            self.queue_depth -= 1
+            ADMISSION_QUEUE_DEPTH.dec()
+
+        waited = self._now() - started
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+        ADMISSION_WAIT_SECONDS.observe(waited)
+
+    # Занимает слот для запроса к модели или сразу выбрасывает Overloaded.
+    # rate_limited=False - фоновая работа бота (сжатие истории): она занимает общий слот,
+    # но не расходует лимит пользователя, который её не запрашивал
+    @asynccontextmanager
+    async def slot(self, user_id: int, rate_limited: bool = True) -> AsyncIterator[None]:
+        if rate_limited and not self._take_user_token(user_id):
+            self.shed += 1
+            ADMISSION_SHED.inc()
+            raise Overloaded("user_rate_limit")
+
+        if self._semaphore is not None:
+            if not self._semaphore.locked():
+                # Свободный слот занимается без ожидания
+                await self._semaphore.acquire()
+            else:
+                await self._wait_for_slot()
+
+        self.admitted += 1
+        self.in_flight += 1
+        ADMISSION_IN_FLIGHT.inc()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            ADMISSION_IN_FLIGHT.dec()
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    # Текущая загрузка и статистика ожидания для мониторинга
+    def stats(self) -> Dict[str, float]:
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "wait_time_avg": self.wait_time_total / self.admitted if self.admitted else 0.0,
+            "wait_time_max": self.wait_time_max,
+        }
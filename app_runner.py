@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import signal
+from typing import Awaitable, Callable
+
+from telegram.ext import Application
+
+from conversation_utils import BotConfig
+
+logger = logging.getLogger(__name__)
+
+
+# Жизненный цикл приложения без встроенного Updater. Обновления поставляет start_source: он получает
+# событие остановки и возвращает функцию, которая прекращает приём новых обновлений.
+# Без handle_signals SIGINT/SIGTERM не останавливают приложение: событие выставляет сам источник
+async def run_application(
+    application: Application,
+    config: BotConfig,
+    start_source: Callable[[asyncio.Event], Awaitable[Callable[[], None]]],
+    handle_signals: bool = True,
+) -> None:
+    stop_event = asyncio.Event()
+    if handle_signals:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    stop_source = await start_source(stop_event)
+
+    try:
+        await stop_event.wait()
+    finally:
+        # Сначала перестаём принимать новые обновления, затем дорабатываем уже принятые
+        stop_source()
+        logger.info("Останавливаю приём обновлений, дожидаюсь обработки принятых.")
+        try:
+            await asyncio.wait_for(application.stop(), config.webhook_drain_timeout or None)
+        except asyncio.TimeoutError:
+            logger.warning("Не все обновления обработаны за %s с.", config.webhook_drain_timeout)
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import logging
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Iterator, List, Optional, Tuple
+
+from conversation_utils import BotConfig
+from metrics import BACKEND_EJECTIONS, BACKENDS_HEALTHY
+from resilience import is_retryable
+
+logger = logging.getLogger(__name__)
+
+# Вес последнего замера в скользящем среднем задержки
+EWMA_ALPHA = 0.3
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+# Бэкенды из конфигурации: "модель" или "модель@адрес"; без списка - одна модель model_name по адресу hf_base_url
+def parse_backends(config: BotConfig) -> List[Tuple[str, str]]:
+    if not config.inference_backends:
+        return [(config.model_name, config.hf_base_url)]
+    backends = []
+    for spec in config.inference_backends:
+        model, _, base_url = spec.partition("@")
+        backends.append((model.strip() or config.model_name, base_url.strip()))
+    return backends
+
+
+class Backend:
+    # Одна модель или один адрес chat-completions API со своими клиентами, нагрузкой и состоянием
+    def __init__(self, model: str, base_url: str, config: BotConfig):
+        from huggingface_hub import AsyncInferenceClient, InferenceClient
+
+        self.model = model
+        self.base_url = base_url
+        self.name = f"{model}@{base_url}" if base_url else model
+        # Таймаут клиента ограничивает одну попытку синхронного запроса, асинхронные попытки ограничивает RetryPolicy
+        timeout = config.inference_timeout or None
+        token = config.hf_token or None
+        self.client = InferenceClient(token=token, base_url=base_url or None, timeout=timeout)
+        # Асинхронный клиент позволяет ждать ответа модели прямо в event loop, не занимая поток на каждый запрос
+        self.async_client = AsyncInferenceClient(token=token, base_url=base_url or None, timeout=timeout)
+        self._token = token
+        self._timeout = timeout
+        # Потоковые ответы AsyncInferenceClient держит в своём exit_stack до закрытия клиента, поэтому потоки
+        # идут через отдельный общий httpx-клиент (huggingface_hub >= 1.0), где каждый ответ закрывается сразу.
+        # Запрос и разбор потока берутся из закрытых модулей huggingface_hub (проверено на 2.2): если в другой
+        # версии их нет, работает запасной путь с отдельным AsyncInferenceClient на каждый поток
+        self._stream_session = None
+        try:
+            from huggingface_hub import get_async_session
+            from huggingface_hub.inference._common import _format_chat_completion_stream_output
+            from huggingface_hub.inference._providers import get_provider_helper
+        except ImportError:
+            logger.info("Потоковые ответы %s идут через отдельный AsyncInferenceClient на каждый поток.", self.name)
+        else:
+            self._stream_session = get_async_session()
+            self._parse_stream_line = _format_chat_completion_stream_output
+            self._provider_helper = get_provider_helper
+        self.outstanding = 0
+        self.ewma: Optional[float] = None
+        self.failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+
+    # Потоковый chat-completion: на выходе из контекста ответ закрывается, а соединение возвращается в пул,
+    # даже если поток дочитан не до конца
+    @asynccontextmanager
+    async def stream_chat(self, messages: List[dict], **parameters: Any) -> AsyncIterator[AsyncIterator[Any]]:
+        if self._stream_session is None:
+            from huggingface_hub import AsyncInferenceClient
+
+            # huggingface_hub без общего httpx-клиента или без нужных функций: отдельный клиент на поток,
+            # его закрытие закрывает и ответ
+            stream_client = AsyncInferenceClient(token=self._token, base_url=self.base_url or None, timeout=self._timeout)
+            async with stream_client:
+                yield await stream_client.chat.completions.create(
+                    model=self.model, messages=messages, stream=True, **parameters
+                )
+            return
+
+        from huggingface_hub.utils import hf_raise_for_status
+
+        # Запрос собирается так же, как в AsyncInferenceClient.chat_completion
+        client = self.async_client
+        model = client.model or self.model
+        request = self._provider_helper(client.provider, task="conversational", model=model).prepare_request(
+            inputs=messages,
+            parameters={"model": self.model, "stream": True, **parameters},
+            headers=client.headers,
+            model=model,
+            api_key=self._token,
+        )
+
+        async def chunks(response: Any) -> AsyncIterator[Any]:
+            done = False
+            async for line in response.aiter_lines():
+                # После [DONE] ответ дочитывается до конца: httpx возвращает в пул только полностью прочитанное соединение
+                if done:
+                    continue
+                try:
+                    chunk = self._parse_stream_line(line.strip())
+                except StopIteration:
+                    done = True
+                    continue
+                if chunk is not None:
+                    yield chunk
+
+        async with self._stream_session.stream(
+            "POST", request.url, json=request.json, headers=request.headers, timeout=self._timeout
+        ) as response:
+            if response.status_code >= 400:
+                # Текст ошибки нужен hf_raise_for_status, а потоковый ответ ещё не прочитан
+                await response.aread()
+            hf_raise_for_status(response)
+            yield chunks(response)
+
+    def stats(self) -> dict:
+        return {
+            "outstanding": self.outstanding,
+            "ewma_ms": round(self.ewma * 1000, 1) if self.ewma is not None else None,
+            "failures": self.failures,
+            "state": self.state,
+        }
+
+
+class BackendPool:
+    # Распределяет запросы между бэкендами (меньше всего запросов в работе или наименьшая EWMA-задержка)
+    # и выводит из ротации бэкенды, которые подряд отвечают ошибками (circuit breaker)
+    def __init__(self, config: BotConfig):
+        if config.balance_strategy not in ("least_outstanding", "ewma"):
+            raise ValueError(f"Неизвестная стратегия балансировки: {config.balance_strategy}")
+        self._strategy = config.balance_strategy
+        self._failure_threshold = max(config.breaker_failures, 1)
+        self._cooldown = config.breaker_cooldown
+        self.backends = [Backend(model, base_url, config) for model, base_url in parse_backends(config)]
+        # Бэкенды выбираются и из event loop, и из пула потоков синхронного пути
+        self._lock = threading.Lock()
+        BACKENDS_HEALTHY.set_function(lambda: sum(backend.state == CLOSED for backend in self.backends))
+
+    def _now(self) -> float:
+        return time.monotonic()
+
+    def _cost(self, backend: Backend) -> float:
+        if self._strategy == "ewma":
+            # Бэкенд без замеров считаем быстрым, чтобы он получил первые запросы
+            return (backend.ewma or 0.0) * (backend.outstanding + 1)
+        return backend.outstanding
+
+    # Выбирает бэкенд для запроса; вызывается под блокировкой
+    def _choose(self) -> Backend:
+        now = self._now()
+        candidates = [backend for backend in self.backends if backend.state == CLOSED]
+        for backend in self.backends:
+            # После паузы выведенный бэкенд получает один пробный запрос
+            if backend.state == OPEN and now - backend.opened_at >= self._cooldown:
+                backend.state = HALF_OPEN
+                logger.info("Пробный запрос к бэкенду %s.", backend.name)
+                return backend
+        if not candidates:
+            # Все бэкенды выведены: лучше попробовать тот, что выведен раньше всех, чем сразу отказать
+            return min(self.backends, key=lambda backend: backend.opened_at)
+        return min(candidates, key=lambda backend: (self._cost(backend), random.random()))
+
+    # Бэкенд на время одного запроса: учитывает нагрузку, задержку и ошибки
+    @contextmanager
+    def lease(self) -> Iterator[Backend]:
+        with self._lock:
+            backend = self._choose()
+            backend.outstanding += 1
+        started = time.perf_counter()
+        try:
+            yield backend
+        except Exception as exc:
+            with self._lock:
+                self._record_failure(backend, exc)
+            raise
+        else:
+            with self._lock:
+                self._record_success(backend, time.perf_counter() - started)
+        finally:
+            with self._lock:
+                backend.outstanding -= 1
+                # Пробный запрос отменён, не дождавшись ответа: следующий запрос снова станет пробным
+                if backend.state == HALF_OPEN:
+                    backend.state = OPEN
+
+    def _record_success(self, backend: Backend, seconds: float) -> None:
+        backend.ewma = seconds if backend.ewma is None else EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * backend.ewma
+        backend.failures = 0
+        if backend.state != CLOSED:
+            backend.state = CLOSED
+            logger.info("Бэкенд %s снова в ротации.", backend.name)
+
+    def _record_failure(self, backend: Backend, exc: BaseException) -> None:
+        # Ошибка запроса (400 и т.п.) означает, что бэкенд ответил, то есть он жив
+        if not is_retryable(exc):
+            backend.failures = 0
+            if backend.state == HALF_OPEN:
+                backend.state = CLOSED
+            return
+        backend.failures += 1
+        if backend.state == HALF_OPEN or (backend.state == CLOSED and backend.failures >= self._failure_threshold):
+            backend.state = OPEN
+            backend.opened_at = self._now()
+            BACKEND_EJECTIONS.inc()
+            logger.warning("Бэкенд %s выведен из ротации на %s с: %r", backend.name, self._cooldown, exc)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {backend.name: backend.stats() for backend in self.backends}
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+
+# Подбирает коэффициенты TokenEstimator по настоящему токенайзеру модели и записывает их в token_ratios.json
+#
+#   python benchmarks/calibrate_tokens.py --model HuggingFaceTB/SmolLM3-3B --corpus chats.txt
+#
+# Нужны transformers и numpy (с --bpe-file вместо transformers - tiktoken). Корпус - текстовые файлы,
+# каждая непустая строка считается отдельным сообщением; лучше всего подходят реальные сообщения
+# пользователей и ответы модели.
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from token_estimator import DEFAULT_RATIOS_PATH, TokenEstimator  # noqa: E402
+
+# Встроенный корпус на случай, если свои тексты не переданы: вопросы пользователей и ответы ассистента
+# на русском и английском, код, числа и эмодзи
+SAMPLE_TEXTS = [
+    "Привет! Расскажи, пожалуйста, как приготовить борщ.",
+    "Какая погода будет завтра в Москве?",
+    "Объясни разницу между процессом и потоком в операционной системе.",
+    "Напиши короткое стихотворение про осень и дождь.",
+    "Сколько будет 1234 умножить на 5678?",
+    "Переведи на английский: я люблю читать книги по вечерам.",
+    "Hello! Can you explain how transformers work in machine learning?",
+    "def fibonacci(n):\n    return n if n < 2 else fibonacci(n - 1) + fibonacci(n - 2)",
+    "Мой заказ №48213 не пришёл, что делать?",
+    "Посоветуй фильм на вечер, что-нибудь вроде «Интерстеллара».",
+    "Как настроить nginx как reverse proxy для приложения на порту 8080?",
+    "Спасибо, это очень помогло :)",
+    "Ура, всё заработало 🎉🎉🎉 спасибо огромное 🙏",
+    "😂😂😂",
+    "Встречаемся в 19:00 ☕️ возле метро 👍",
+    "привет",
+    "ок",
+    "а можно подробнее?",
+    "Не понял, объясни ещё раз, только проще",
+    "Что такое квантовая запутанность простыми словами?",
+    "Помоги составить план тренировок на неделю для начинающего, 3 раза в неделю по часу.",
+    "Как написать резюме, если нет опыта работы?",
+    "Почему небо голубое, а закат красный?",
+    "Сравни Python и Go для написания backend-сервиса с высокой нагрузкой.",
+    "У меня ошибка ModuleNotFoundError: No module named 'telegram', что делать?",
+    "Напиши SQL-запрос, который выбирает 10 самых активных пользователей за последний месяц.",
+    "Какие документы нужны для получения загранпаспорта в 2024 году?",
+    "Придумай 5 названий для кофейни в спальном районе",
+    "Сократи этот текст до двух предложений, сохранив главный смысл.",
+    "What is the capital of Australia?",
+    "Write a haiku about the sea.",
+    "How do I reverse a linked list in place? Please give an example in C++.",
+    "Thanks a lot, that's exactly what I needed!",
+    "Can you summarize the plot of War and Peace in a few sentences?",
+    "Is it safe to run `rm -rf node_modules && npm install` on a production server?",
+    "Борщ готовится так: сначала сварите бульон из говядины (около 1,5 часа), затем добавьте нарезанный картофель "
+    "и капусту. Отдельно обжарьте лук, морковь и свёклу с томатной пастой, переложите зажарку в кастрюлю "
+    "и варите ещё 10–15 минут. В конце посолите, добавьте чеснок и зелень, дайте настояться.",
+    "Процесс — это экземпляр программы со своим адресным пространством, а поток — единица выполнения внутри "
+    "процесса. Потоки одного процесса разделяют память, поэтому обмениваться данными им проще, но нужна "
+    "синхронизация: мьютексы, семафоры или очереди.",
+    "1234 × 5678 = 7 006 652.",
+    "Вот несколько вариантов:\n1. «Зерно и пар»\n2. «Утренний рейс»\n3. «Кофе у дома»\n4. «Тёплый угол»\n5. «Чашка района»",
+    "Если заказ не пришёл в срок, проверьте статус по трек-номеру на сайте службы доставки. Если статус "
+    "не обновлялся больше недели, напишите в поддержку магазина и приложите номер заказа и скриншот.",
+    "Небо голубое из-за рэлеевского рассеяния: короткие синие волны рассеиваются в атмосфере сильнее красных. "
+    "На закате свет проходит через более толстый слой воздуха, синяя часть рассеивается по пути, "
+    "и до нас доходят в основном красные и оранжевые лучи.",
+    "Для reverse proxy добавьте в конфигурацию сервера:\n\nlocation / {\n    proxy_pass http://127.0.0.1:8080;\n"
+    "    proxy_set_header Host $host;\n    proxy_set_header X-Real-IP $remote_addr;\n}\n\nЗатем выполните "
+    "nginx -t и systemctl reload nginx.",
+    "SELECT user_id, COUNT(*) AS messages\nFROM events\nWHERE created_at >= NOW() - INTERVAL '30 days'\n"
+    "GROUP BY user_id\nORDER BY messages DESC\nLIMIT 10;",
+    "Пример плана:\n- Понедельник: разминка 10 минут, приседания 3×12, отжимания 3×10, планка 3×30 с.\n"
+    "- Среда: бег трусцой 20 минут, выпады 3×10 на каждую ногу.\n- Пятница: круговая тренировка из 5 упражнений, "
+    "3 круга, отдых между кругами 2 минуты.",
+    "Transformers process a sequence with self-attention: every token computes weighted sums over all other "
+    "tokens, so the model can capture long-range dependencies without recurrence. Positional encodings tell "
+    "the model where each token is located.",
+    "```python\nclass Node:\n    def __init__(self, value, next=None):\n        self.value = value\n"
+    "        self.next = next\n\n\ndef reverse(head):\n    prev = None\n    while head:\n"
+    "        head.next, prev, head = prev, head, head.next\n    return prev\n```",
+    "Ошибка означает, что пакет не установлен в текущем окружении. Выполните pip install python-telegram-bot "
+    "и убедитесь, что запускаете скрипт тем же интерпретатором: python -m pip показывает, куда ставятся пакеты.",
+    "Квантовая запутанность — это связь между частицами, при которой измерение одной сразу определяет результат "
+    "измерения другой, как бы далеко они ни находились. Передать так информацию быстрее света нельзя.",
+    "Python проще в разработке и богаче библиотеками, Go быстрее стартует, потребляет меньше памяти "
+    "и из коробки хорошо справляется с тысячами одновременных соединений благодаря горутинам.",
+    "Курс на сегодня: 1 USD = 92,35 RUB, 1 EUR = 99,80 RUB (данные на 12.03.2024).",
+    "Телефон поддержки: +7 (495) 123-45-67, e-mail: support@example.com",
+    "https://example.com/docs/getting-started?lang=ru#install",
+    "Хорошего дня! 😊",
+    "Сделал как ты сказал, но теперь пишет Permission denied (publickey). Ключ добавил в ~/.ssh/authorized_keys 🤔",
+    "Можешь ответить по-английски? My Russian is not very good yet.",
+    "Кстати, а что лучше купить: iPhone 15 или Samsung Galaxy S24? Бюджет до 90 000 ₽.",
+    "Пожалуйста, проверь грамматику: «Я хотел бы узнать о ваших услугах и ценах на них».",
+    "Расскажи анекдот про программистов",
+    "— Доктор, у меня баг!\n— Это не баг, это фича. Следующий!",
+    "Итого: 3 шага, 15 минут, никаких внешних зависимостей. Если что-то не получится — пишите, разберёмся 👌",
+]
+
+
+def load_texts(paths: List[str]) -> List[str]:
+    if not paths:
+        return SAMPLE_TEXTS
+    texts: List[str] = []
+    for path in paths:
+        with open(path, encoding="utf-8") as file:
+            texts.extend(line.strip() for line in file if line.strip())
+    return texts
+
+
+# Разбиение на слова перед BPE у токенайзера Llama 3 (и SmolLM3)
+LLAMA3_SPLIT_PATTERN = (
+    r"(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*"
+    r"|\s*[\r\n]+|\s+(?!\S)|\s+"
+)
+
+
+# Счётчик токенов без служебных токенов: токенайзер модели из transformers или словарь BPE из файла
+def load_counter(model: str, bpe_file: Optional[str]) -> Callable[[str], int]:
+    if bpe_file:
+        import tiktoken
+        from tiktoken.load import load_tiktoken_bpe
+
+        encoding = tiktoken.Encoding(
+            Path(bpe_file).name,
+            pat_str=LLAMA3_SPLIT_PATTERN,
+            mergeable_ranks=load_tiktoken_bpe(bpe_file),
+            special_tokens={},
+        )
+        return lambda text: len(encoding.encode_ordinary(text))
+
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model)
+    return lambda text: len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Калибровка быстрой оценки токенов")
+    parser.add_argument("--model", default="HuggingFaceTB/SmolLM3-3B")
+    parser.add_argument("--corpus", nargs="*", default=[], help="текстовые файлы, по сообщению на строку")
+    parser.add_argument("--output", default=str(DEFAULT_RATIOS_PATH))
+    parser.add_argument("--dry-run", action="store_true", help="только показать результат, не записывая файл")
+    parser.add_argument(
+        "--bpe-file",
+        help="словарь BPE в формате tiktoken вместо загрузки токенайзера --model с Hugging Face "
+        "(например, tokenizer.model Llama 3, словарь которого использует и SmolLM3); нужен tiktoken",
+    )
+    args = parser.parse_args(argv)
+
+    import numpy as np
+
+    count_tokens = load_counter(args.model, args.bpe_file)
+    texts = load_texts(args.corpus)
+
+    started = time.perf_counter()
+    exact = [count_tokens(text) for text in texts]
+    exact_seconds = time.perf_counter() - started
+
+    features = np.array([TokenEstimator.features(text) + (1,) for text in texts], dtype=float)
+    target = np.array(exact, dtype=float)
+    # Минимизируем относительную ошибку: без весов подбор подстраивается под длинные тексты,
+    # а короткие сообщения, которых в чате большинство, оцениваются с ошибкой в разы
+    weights = 1 / np.maximum(target, 1)
+    solution, *_ = np.linalg.lstsq(features * weights[:, None], target * weights, rcond=None)
+    ascii_ratio, non_ascii_ratio, word_ratio, intercept = (float(value) for value in solution)
+    estimator = TokenEstimator(ascii_ratio, non_ascii_ratio, word_ratio, intercept)
+
+    started = time.perf_counter()
+    estimated = [estimator.count(text) for text in texts]
+    estimate_seconds = time.perf_counter() - started
+
+    def mean_relative_error(values: List[int]) -> float:
+        return sum(abs(value - real) / real for value, real in zip(values, exact) if real) / len(texts)
+
+    split_error = mean_relative_error([len(text.split()) for text in texts])
+    estimate_error = mean_relative_error(estimated)
+
+    print(f"{'texts':>28}: {len(texts)}")
+    print(f"{'coefficients':>28}: {json.dumps(estimator.to_dict())}")
+    print(f"{'split() rel. error':>28}: {split_error:.3f}")
+    print(f"{'estimate rel. error':>28}: {estimate_error:.3f}")
+    print(f"{'tokenizer, us/text':>28}: {exact_seconds / len(texts) * 1e6:.1f}")
+    print(f"{'estimate, us/text':>28}: {estimate_seconds / len(texts) * 1e6:.1f}")
+
+    if args.dry_run:
+        return
+
+    output = Path(args.output)
+    data = json.loads(output.read_text(encoding="utf-8")) if output.exists() else {"default": {}, "models": {}}
+    params = estimator.to_dict()
+    params.update(samples=len(texts), mean_abs_error=round(estimate_error, 4))
+    data["models"][args.model] = params
+    if not data.get("default"):
+        data["default"] = estimator.to_dict()
+    output.write_text(json.dumps(data, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+    print(f"Коэффициенты для {args.model} записаны в {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import json
+import multiprocessing
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+# Локальная замена HF chat-completions API для нагрузочных тестов: отвечает с заданной задержкой и скоростью токенов
+
+
+class FakeInferenceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Параметры задаются в FakeInferenceServer
+    latency = 0.2  # задержка до первого токена в секундах
+    token_rate = 50.0  # токенов в секунду после первого
+    reply_tokens = 40  # длина ответа в токенах
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", "0"))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+
+        tokens = min(self.reply_tokens, int(payload.get("max_tokens") or self.reply_tokens))
+        words = [f"слово{i}" for i in range(tokens)]
+        model = payload.get("model", "fake")
+        time.sleep(self.latency)
+
+        if payload.get("stream"):
+            self._stream(model, words)
+            return
+
+        if self.token_rate > 0:
+            time.sleep(tokens / self.token_rate)
+        body = json.dumps(
+            {
+                "id": "fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "system_fingerprint": "fake",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": " ".join(words)},
+                    }
+                ],
+                "usage": {"prompt_tokens": 0, "completion_tokens": tokens, "total_tokens": tokens},
+            },
+            ensure_ascii=False,
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Отдаёт ответ по токену в формате server-sent events, как делает API при stream=True
+    def _stream(self, model: str, words) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        delay = 1.0 / self.token_rate if self.token_rate > 0 else 0.0
+        for index, word in enumerate(words):
+            chunk = {
+                "id": "fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "system_fingerprint": "fake",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": None,
+                        "delta": {"role": "assistant", "content": word if index == 0 else " " + word},
+                    }
+                ],
+            }
+            self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+            if delay:
+                time.sleep(delay)
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, text: str) -> None:
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+class _Server(ThreadingHTTPServer):
+    # Очередь входящих соединений по умолчанию (5) слишком мала для сотен одновременных клиентов
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def _make_server(latency: float, token_rate: float, reply_tokens: int, port: int) -> _Server:
+    handler = type(
+        "ConfiguredFakeInferenceHandler",
+        (FakeInferenceHandler,),
+        {"latency": latency, "token_rate": token_rate, "reply_tokens": reply_tokens},
+    )
+    return _Server(("127.0.0.1", port), handler)
+
+
+# Точка входа дочернего процесса: сообщает родителю порт и обслуживает запросы до завершения
+def _serve(conn, latency: float, token_rate: float, reply_tokens: int, port: int) -> None:
+    server = _make_server(latency, token_rate, reply_tokens, port)
+    conn.send(server.server_address[1])
+    conn.close()
+    server.serve_forever()
+
+
+class FakeInferenceServer:
+    # Запускает фейковый сервер в отдельном процессе, чтобы он не делил GIL с измеряемым ботом.
+    # Адрес для HF_BASE_URL доступен в base_url после start().
+    def __init__(self, latency: float = 0.2, token_rate: float = 50.0, reply_tokens: int = 40, port: int = 0):
+        self._options = (latency, token_rate, reply_tokens, port)
+        self._process: Optional[multiprocessing.Process] = None
+        self._port = port
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._port}/v1/"
+
+    def start(self) -> "FakeInferenceServer":
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        self._process = multiprocessing.Process(target=_serve, args=(child_conn, *self._options), daemon=True)
+        self._process.start()
+        self._port = parent_conn.recv()
+        parent_conn.close()
+        return self
+
+    def stop(self) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Фейковый HF chat-completions API")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--token-rate", type=float, default=50.0)
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    args = parser.parse_args()
+    _make_server(args.latency, args.token_rate, args.reply_tokens, args.port).serve_forever()
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import argparse
+import gc
+import sys
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Сравнивает память истории диалогов в Message (__slots__) с прежним представлением списком словарей
+#
+#   python benchmarks/history_memory.py --users 50000 --turns 4
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from conversation_utils import BotConfig, ConversationManager  # noqa: E402
+
+
+# Выделенная за время build() память в байтах по данным tracemalloc
+def traced_bytes(build: Callable[[], object]) -> Tuple[int, object]:
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    result = build()
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return after - before, result
+
+
+def build_manager(args: argparse.Namespace, texts: List[str]) -> ConversationManager:
+    config = BotConfig(history_max_pairs=args.turns, history_max_tokens=0, history_ttl_seconds=0)
+    manager = ConversationManager(tokenizer=None, config=config)
+    for user_id in range(args.users):
+        for turn in range(args.turns):
+            manager.add_user_message(user_id, texts[turn * 2])
+            manager.add_assistant_message(user_id, texts[turn * 2 + 1])
+    return manager
+
+
+# Прежнее представление: новый словарь на каждое сообщение, включая системное
+def build_dicts(args: argparse.Namespace, texts: List[str], system_prompt: str) -> Dict[int, List[Dict[str, str]]]:
+    store: Dict[int, List[Dict[str, str]]] = {}
+    for user_id in range(args.users):
+        history = [{"role": "system", "content": system_prompt}]
+        for turn in range(args.turns):
+            history.append({"role": "user", "content": texts[turn * 2]})
+            history.append({"role": "assistant", "content": texts[turn * 2 + 1]})
+        store[user_id] = history
+    return store
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Память истории диалогов: Message против словарей")
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--turns", type=int, default=4, help="пар user/assistant на пользователя")
+    args = parser.parse_args(argv)
+
+    # Тексты общие для обоих вариантов, чтобы сравнивать только накладные расходы на сообщения
+    texts = [f"Сообщение номер {index} для замера памяти" for index in range(args.turns * 2)]
+    system_prompt = BotConfig().system_prompt
+
+    dict_bytes, _ = traced_bytes(lambda: build_dicts(args, texts, system_prompt))
+    slot_bytes, _ = traced_bytes(lambda: build_manager(args, texts))
+
+    print(f"{'users':>20}: {args.users}")
+    print(f"{'dict bytes/user':>20}: {dict_bytes / args.users:.1f}")
+    print(f"{'Message bytes/user':>20}: {slot_bytes / args.users:.1f}")
+    print(f"{'saving':>20}: {100 * (1 - slot_bytes / dict_bytes):.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Замеряет холодный импорт llm_bot и создание приложения в отдельных процессах и следит,
+# чтобы тяжёлые библиотеки не загружались при импорте модуля
+#
+#   python benchmarks/import_time.py --runs 5 --max-import-ms 300
+#
+# Код возврата 1, если превышен лимит времени или при импорте загрузился запрещённый модуль.
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Эти модули нужны только при работе бота (или только локальной модели), но не при импорте llm_bot
+FORBIDDEN_ON_IMPORT = ("transformers", "torch", "telegram", "huggingface_hub.inference")
+
+PROBE = """
+import json, resource, sys, time
+started = time.perf_counter()
+import llm_bot
+imported = time.perf_counter()
+loaded = sorted(name for name in sys.modules if name.split(".")[0] in {forbidden_roots})
+llm_bot.create_application()
+created = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (imported - started) * 1000,
+    "app_ms": (created - imported) * 1000,
+    "loaded": loaded,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}}))
+"""
+
+
+def probe_once() -> Dict[str, object]:
+    roots = sorted({name.split(".")[0] for name in FORBIDDEN_ON_IMPORT})
+    env = dict(os.environ)
+    env.setdefault("TELEGRAM_TOKEN", "123:IMPORTTEST")
+    env.setdefault("HF_TOKEN", "hf_importtest")
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(forbidden_roots=roots)],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Время холодного импорта и запуска бота")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, default=0.0, help="лимит медианы импорта (0 - без лимита)")
+    args = parser.parse_args(argv)
+
+    runs = [probe_once() for _ in range(args.runs)]
+    import_ms = statistics.median(run["import_ms"] for run in runs)
+    app_ms = statistics.median(run["app_ms"] for run in runs)
+    loaded = sorted({
+        name
+        for run in runs
+        for name in run["loaded"]
+        if any(name == forbidden or name.startswith(forbidden + ".") for forbidden in FORBIDDEN_ON_IMPORT)
+    })
+
+    print(f"{'import llm_bot, ms':>24}: {import_ms:.1f}")
+    print(f"{'create_application, ms':>24}: {app_ms:.1f}")
+    print(f"{'max_rss_mb':>24}: {max(run['max_rss_mb'] for run in runs):.1f}")
+    print(f"{'heavy modules on import':>24}: {', '.join(loaded) or '-'}")
+
+    failed = bool(loaded)
+    if args.max_import_ms > 0 and import_ms > args.max_import_ms:
+        print(f"Импорт дольше лимита {args.max_import_ms:.0f} мс")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
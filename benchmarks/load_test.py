@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import time
+import resource
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+# Нагрузочный тест бота: синтетические Update идут в handle_message (или напрямую в generate_response),
+# модель заменена локальным фейковым сервером, Telegram - фейковым ботом в памяти процесса.
+#
+#   python benchmarks/load_test.py --users 2000 --messages 3 --concurrency 200 --latency 0.3
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fake_inference import FakeInferenceServer  # noqa: E402
+
+
+class FakeTelegramBot:
+    # Минимальная замена telegram.Bot: запоминает время отправки ответов вместо обращения к Bot API
+    def __init__(self) -> None:
+        self.sent = 0
+        self.edited = 0
+        self._next_message_id = 1
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> SimpleNamespace:
+        self.sent += 1
+        self._next_message_id += 1
+        return SimpleNamespace(message_id=self._next_message_id, chat_id=chat_id, text=text)
+
+    async def edit_message_text(self, text: str, chat_id: int, message_id: int, **kwargs) -> bool:
+        self.edited += 1
+        return True
+
+    async def send_chat_action(self, chat_id: int, action: str, **kwargs) -> bool:
+        return True
+
+
+# Собирает настоящий telegram.Update из JSON, как если бы он пришёл от Telegram
+def make_update(bot: FakeTelegramBot, update_id: int, user_id: int, text: str):
+    from telegram import Update
+
+    data = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        },
+    }
+    return Update.de_json(data, bot)
+
+
+# Рекурсивный размер объекта в байтах с учётом общих ссылок (tracemalloc искажал бы замеры задержек)
+def deep_sizeof(obj, seen: Optional[set] = None) -> int:
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), seen)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deep_sizeof(getattr(obj, name), seen) for name in obj.__slots__ if hasattr(obj, name))
+    return size
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_load(args: argparse.Namespace) -> Dict[str, float]:
+    import llm_bot
+    from http_pool import connection_stats
+
+    llm_bot.init_services()
+    # Логи каждого сообщения заметно замедляют event loop и искажают замеры
+    logging.getLogger().setLevel(args.log_level)
+    bot = FakeTelegramBot()
+    context = SimpleNamespace(bot=bot)
+    limiter = asyncio.Semaphore(args.concurrency)
+    latencies: List[float] = []
+
+    # Каждый пользователь отправляет свои сообщения последовательно, пользователи работают параллельно
+    async def simulate_user(user_id: int) -> None:
+        async with limiter:
+            for index in range(args.messages):
+                text = f"Вопрос номер {index} от пользователя {user_id}: расскажи что-нибудь интересное"
+                started = time.perf_counter()
+                if args.target == "generate":
+                    if llm_bot.CONFIG.use_async_client:
+                        await llm_bot.generate_response_async(user_id, text)
+                    else:
+                        await llm_bot.run_generate_response_in_executor(user_id, text)
+                else:
+                    update = make_update(bot, user_id * args.messages + index, user_id, text)
+                    await llm_bot.handle_message(update, context)
+                latencies.append(time.perf_counter() - started)
+
+    store = llm_bot.conversation_manager._store
+    store_before = deep_sizeof(store)
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate_user(user_id) for user_id in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - started
+    store_after = deep_sizeof(store)
+
+    total = len(latencies)
+    http = connection_stats()
+    return {
+        "messages": total,
+        "elapsed_s": elapsed,
+        "messages_per_s": total / elapsed if elapsed else 0.0,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p95_ms": percentile(latencies, 95) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "latency_mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        "store_entries": len(store),
+        "store_growth_kb": (store_after - store_before) / 1024,
+        "store_bytes_per_user": (store_after - store_before) / max(len(store), 1),
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "telegram_sent": bot.sent,
+        "telegram_edited": bot.edited,
+        # Новых соединений должно быть не больше размера пула: остальные запросы идут по keep-alive
+        "http_requests": http["requests"],
+        "http_connections": http["connections"],
+        "http_reuse_ratio": http["reuse_ratio"] or 0.0,
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест LLM-бота с фейковыми Telegram и Inference API")
+    parser.add_argument("--users", type=int, default=1000, help="число синтетических пользователей")
+    parser.add_argument("--messages", type=int, default=3, help="сообщений от каждого пользователя")
+    parser.add_argument("--concurrency", type=int, default=100, help="сколько пользователей активны одновременно")
+    parser.add_argument("--latency", type=float, default=0.2, help="задержка фейковой модели до первого токена, с")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="скорость генерации фейковой модели, токенов/с")
+    parser.add_argument("--reply-tokens", type=int, default=40, help="длина ответа фейковой модели в токенах")
+    parser.add_argument(
+        "--target",
+        choices=("handle", "generate"),
+        default="handle",
+        help="handle - через handle_message с синтетическими Update, generate - напрямую generate_response",
+    )
+    parser.add_argument("--log-level", default="WARNING", help="уровень логирования бота во время теста")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    server = FakeInferenceServer(
+        latency=args.latency,
+        token_rate=args.token_rate,
+        reply_tokens=args.reply_tokens,
+    ).start()
+
+    # Конфигурация бота читается из окружения в llm_bot.init_services, поэтому окружение готовим заранее
+    os.environ.setdefault("TELEGRAM_TOKEN", "123:LOADTEST")
+    os.environ.setdefault("HF_TOKEN", "hf_loadtest")
+    os.environ["HF_BASE_URL"] = server.base_url
+
+    try:
+        report = asyncio.run(run_load(args))
+    finally:
+        server.stop()
+
+    for key, value in report.items():
+        print(f"{key:>24}: {value:.2f}" if isinstance(value, float) else f"{key:>24}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+
+# Сравнивает ThinkFilter с прежней очисткой ответа регулярным выражением: готовый ответ целиком
+# и потоковый ответ, где видимый текст нужен после каждого фрагмента
+#
+#   python benchmarks/think_filter.py --think-tokens 500 --answer-tokens 200
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from think_filter import ThinkFilter, strip_think  # noqa: E402
+
+THINK_RE = re.compile(r"<think>.*?</think>", flags=re.IGNORECASE | re.DOTALL)
+
+
+# Прежний _clean_model_output
+def regex_clean(text: str) -> str:
+    if "<think>" not in text.lower():
+        return text
+    return THINK_RE.sub("", text).strip()
+
+
+# Прежний _visible_stream_text: каждый раз разбирает весь накопленный текст
+def regex_visible(text: str) -> str:
+    cleaned = THINK_RE.sub("", text)
+    lowered = cleaned.lower()
+    start = lowered.find("<think>")
+    if start != -1:
+        cleaned = cleaned[:start]
+    else:
+        tail = cleaned.rfind("<")
+        if tail != -1 and "<think>".startswith(lowered[tail:]):
+            cleaned = cleaned[:tail]
+    return cleaned.strip()
+
+
+# Фрагменты ответа модели: блок рассуждений, затем ответ; теги разрезаны между фрагментами
+def make_chunks(think_tokens: int, answer_tokens: int) -> List[str]:
+    chunks = ["<th", "ink>"]
+    chunks += [f" рассуждение{index}" for index in range(think_tokens)]
+    chunks += ["</thi", "nk>", "\n\n"]
+    chunks += [f" слово{index}" for index in range(answer_tokens)]
+    return chunks
+
+
+def regex_stream(chunks: List[str]) -> str:
+    raw = ""
+    for chunk in chunks:
+        raw += chunk
+        regex_visible(raw)
+    return regex_clean(raw.strip())
+
+
+def filter_stream(chunks: List[str]) -> str:
+    think = ThinkFilter()
+    for chunk in chunks:
+        think.feed(chunk)
+    think.finish()
+    return think.text.strip()
+
+
+# Среднее время одного вызова в микросекундах
+def timed(function: Callable[[], str], repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="ThinkFilter против регулярного выражения")
+    parser.add_argument("--think-tokens", type=int, default=500, help="фрагментов в блоке рассуждений")
+    parser.add_argument("--answer-tokens", type=int, default=200, help="фрагментов видимого ответа")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    chunks = make_chunks(args.think_tokens, args.answer_tokens)
+    text = "".join(chunks)
+    if regex_clean(text) != strip_think(text) or regex_stream(chunks) != filter_stream(chunks):
+        raise SystemExit("Результаты регулярного выражения и ThinkFilter различаются")
+
+    results = {
+        "regex full text, us": timed(lambda: regex_clean(text), args.repeat),
+        "filter full text, us": timed(lambda: strip_think(text), args.repeat),
+        "regex stream, us": timed(lambda: regex_stream(chunks), max(args.repeat // 20, 1)),
+        "filter stream, us": timed(lambda: filter_stream(chunks), args.repeat),
+    }
+    print(f"{'chunks':>22}: {len(chunks)}")
+    for key, value in results.items():
+        print(f"{key:>22}: {value:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,94 @@
 from __future__ import annotations
 
+import json
+import sqlite3
+import threading
 import time
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from typing import Dict, List, Optional
+from collections.abc import Sequence
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple, Union
 
-try:
-    from transformers import PreTrainedTokenizerBase 
-except ImportError:
-    PreTrainedTokenizerBase = object  
+from metrics import HISTORY_PURGE_SECONDS, HISTORY_TRUNCATE_SECONDS
+from token_estimator import TokenEstimator
+
+# transformers нужен только для аннотации типа, импорт библиотеки занимает секунды
+if TYPE_CHECKING:
+    from transformers import PreTrainedTokenizerBase
 
 
 # Словарь соответствует формату сообщений chat-completion API (role + content)
 ChatMessage = Dict[str, str]
 
+# Сколько вытесненных реплик ждать сжатия; если модель долго недоступна, самые старые отбрасываются
+SUMMARY_MAX_PENDING = 32
+
+# Роли хранятся кодом в Message, строка восстанавливается по этому кортежу
+MESSAGE_ROLES = ("system", "user", "assistant")
+_ROLE_CODES = {role: code for code, role in enumerate(MESSAGE_ROLES)}
+
+
+class Message:
+    # Компактное сообщение истории: без __dict__ и со ссылкой на роль по коду вместо отдельной строки.
+    # Поддерживает msg["role"] и msg["content"], поэтому читается так же, как ChatMessage.
+    __slots__ = ("role_code", "content")
+
+    def __init__(self, role: str, content: str):
+        self.role_code = _ROLE_CODES[role]
+        self.content = content
+
+    @property
+    def role(self) -> str:
+        return MESSAGE_ROLES[self.role_code]
+
+    def __getitem__(self, key: str) -> str:
+        if key == "role":
+            return self.role
+        if key == "content":
+            return self.content
+        raise KeyError(key)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self.role_code == other.role_code and self.content == other.content
+
+    def __repr__(self) -> str:
+        return f"Message({self.role!r}, {self.content!r})"
+
+    # Формат chat-completion API; создаётся только на границе с моделью
+    def to_dict(self) -> ChatMessage:
+        return {"role": self.role, "content": self.content}
+
+    @classmethod
+    def from_dict(cls, message: ChatMessage) -> "Message":
+        return cls(message["role"], message["content"])
+
+
+class HistoryView(Sequence):
+    # Представление истории только для чтения: get_history не копирует список на каждый запрос
+    __slots__ = ("_messages",)
+
+    def __init__(self, messages: List[Message]):
+        self._messages = messages
+
+    def __getitem__(self, index):
+        return self._messages[index]
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[Message]:
+        return iter(self._messages)
+
+
+# Переводит историю в список словарей для chat-completion API или чат-шаблона токенайзера
+def to_api_messages(history: Sequence[Union[Message, ChatMessage]]) -> List[ChatMessage]:
+    return [
+        msg.to_dict() if isinstance(msg, Message) else {"role": msg["role"], "content": msg["content"]}
+        for msg in history
+    ]
+
 
 @dataclass
 class BotConfig:
@@ -20,6 +96,11 @@ class BotConfig:
     telegram_token: str = "" # ключ Telegram-бота
     hf_token: str = ""  # ключ Hugging Face Inference
     model_name: str = "HuggingFaceTB/SmolLM3-3B"  # идентификатор модели в HF
+    hf_base_url: str = ""  # свой адрес chat-completions API (например, локальный сервер); пусто - HF Inference
+    inference_backends: List[str] = field(default_factory=list)  # пул бэкендов "модель" или "модель@адрес"; пусто - model_name по hf_base_url
+    balance_strategy: str = "least_outstanding"  # выбор бэкенда: least_outstanding - меньше запросов в работе, ewma - быстрее в среднем
+    breaker_failures: int = 5  # ошибок подряд, после которых бэкенд выводится из ротации
+    breaker_cooldown: float = 30.0  # через сколько секунд выведенный бэкенд получает пробный запрос
     system_prompt: str = "Ты - полезный ассистент. Отвечай на русском языке. Используй не более 400 токенов."  # базовый промпт для модели
     max_new_tokens: int = 400  # ограничение на длину генерируемого ответа
     temperature: float = 0.7  # параметр стохастичности, чем выше значение, тем выше вероятность случайности и ответы будут более разнообразными, чем ниже значение, тем более детерминированным и более предсказуемым будет ответ
@@ -28,22 +109,292 @@ class BotConfig:
     history_max_pairs: int = 4  # максимум пар user/assistant, которые сохраняем
     history_max_tokens: int = 2048  # лимит токенов на историю
     history_ttl_seconds: int = 3600  # время жизни истории без активности
+    history_max_users: int = 0  # максимум хранимых диалогов, при превышении вытесняем самый давний (0 - без лимита)
+    history_purge_interval: float = 0.0  # период фоновой очистки в секундах (0 - очищать при каждом сообщении)
+    history_backend: str = "memory"  # где хранить диалоги: memory или sqlite
+    history_db_path: str = "conversations.sqlite3"  # файл базы для sqlite-хранилища
+    history_write_batch: int = 32  # сколько изменённых диалогов копить перед записью в базу
+    history_flush_interval: float = 5.0  # не дольше скольких секунд изменения ждут записи в базу (0 - только пачками)
+    token_counter: str = "auto"  # подсчёт токенов истории: auto - токенайзер, если он загружен, иначе оценка; estimate - всегда оценка; exact - загрузить токенайзер
+    history_summarize: bool = False  # сжимать вытесненные реплики в краткое содержание вместо удаления
+    history_summary_max_tokens: int = 256  # длина краткого содержания, токенов
+    history_summary_prompt: str = (
+        "Ты сжимаешь переписку пользователя с ассистентом. Обнови краткое содержание, добавив в него "
+        "важное из новых реплик: темы разговора, факты о пользователе, договорённости. "
+        "Пиши кратко, на русском языке, без вступлений."
+    )  # инструкция модели для сжатия истории
     model_device: str = "auto"  # выбор устройства при локальном запуске
+    inference_backend: str = "remote"  # remote - HF Inference API, local - модель в процессе через transformers
+    local_quantize_int8: bool = False  # динамическое int8-квантование локальной модели на CPU
+    local_threads: int = 0  # потоков torch для локальной модели (0 - по умолчанию)
+    local_batch_size: int = 1  # максимум промптов в одном пакете локальной генерации (1 - без пакетов)
+    local_batch_wait_ms: float = 20.0  # сколько ждать остальных запросов пакета, мс
+    local_prefix_cache_mb: int = 0  # бюджет памяти на KV-кэш префиксов диалогов, МБ (0 - выключен)
+    local_system_prompt_cache: bool = True  # один общий KV-кэш системного промпта на процесс
+    use_async_client: bool = True  # асинхронный клиент прямо в event loop вместо пула потоков
+    inference_threads: int = 8  # размер отдельного пула потоков для синхронной генерации
+    inference_timeout: float = 60.0  # таймаут одной попытки запроса к модели в секундах (0 - без ограничения)
+    inference_retries: int = 2  # сколько раз повторять запрос при таймауте, сетевой ошибке, 429 или 5xx
+    retry_backoff: float = 0.5  # базовая задержка экспоненциального повтора в секундах
+    retry_backoff_max: float = 10.0  # максимальная задержка повтора; если Retry-After больше, запрос не повторяется
+    inference_hedge: bool = False  # дублировать запрос, если он не ответил за inference_hedge_percentile недавних попыток
+    inference_hedge_percentile: float = 95.0  # перцентиль задержки, после которого отправляется дублирующий запрос
+    http_pool_size: int = 0  # соединений в HTTP-пуле клиента модели (0 - по лимиту одновременных запросов)
+    http_keepalive_expiry: float = 30.0  # сколько секунд держать простаивающее соединение открытым (0 - без ограничения)
+    http2: bool = False  # HTTP/2 к API модели: все запросы идут по одному соединению (нужен пакет h2)
+    stream_replies: bool = False  # отправлять ответ по мере генерации, редактируя сообщение
+    stream_edit_interval: float = 1.0  # минимальный интервал между правками сообщения в секундах
+    response_cache_size: int = 0  # сколько ответов хранить в кэше (0 - кэш выключен)
+    response_cache_ttl: int = 3600  # время жизни закэшированного ответа в секундах
+    response_cache_first_turns: bool = False  # разрешить кэш первых реплик даже при temperature > 0
+    max_concurrent_requests: int = 0  # одновременных запросов к модели (0 - без ограничения)
+    max_queued_requests: int = 100  # сколько запросов может ждать свободного слота, остальные получают отказ
+    queue_timeout: float = 30.0  # максимальное ожидание слота в секундах (0 - без ограничения)
+    user_rate_limit: int = 0  # запросов пользователя за user_rate_period (0 - без ограничения)
+    user_rate_period: float = 60.0  # окно лимита пользователя в секундах
+    update_mode: str = "polling"  # способ получения обновлений: polling или webhook
+    concurrent_updates: int = 256  # сколько обновлений обрабатывается одновременно
+    workers: int = 1  # процессов-обработчиков; больше 1 - супервизор распределяет обновления по hash(user_id) % workers
+    telegram_api_url: str = ""  # альтернативный адрес Bot API, например локальный фейковый сервер
+    webhook_url: str = ""  # публичный адрес бота; пусто - webhook в Telegram не регистрируется
+    webhook_listen: str = "0.0.0.0"  # адрес, на котором слушает webhook-сервер
+    webhook_port: int = 8443  # порт webhook-сервера
+    webhook_path: str = "telegram"  # путь, на который приходят обновления
+    webhook_secret: str = ""  # секрет из заголовка X-Telegram-Bot-Api-Secret-Token
+    webhook_drain_timeout: float = 30.0  # сколько ждать обработки принятых обновлений при остановке
+    metrics_port: int = 0  # порт HTTP-эндпоинта /metrics (0 - выключен)
+    metrics_listen: str = "127.0.0.1"  # адрес эндпоинта /metrics
 
 
 @dataclass
 class ConversationEntry:
     # Структура для хранения истории конкретного пользователя 
-    history: List[ChatMessage] = field(default_factory=list)
+    history: List[Message] = field(default_factory=list)
     updated_at: float = field(default_factory=time.time)
+    # Кэш количества токенов для каждого сообщения (индексы совпадают с history) и их сумма
+    token_counts: List[int] = field(default_factory=list)
+    token_total: int = 0
+    # Краткое содержание вытесненных реплик и реплики, которые ещё ждут сжатия (history_summarize)
+    summary: str = ""
+    evicted: List[Message] = field(default_factory=list)
+
+
+class ConversationStore:
+    # Интерфейс хранилища диалогов; записи отдаются в порядке от самой давней к самой свежей активности
+    def get(self, user_id: int) -> Optional[ConversationEntry]:
+        raise NotImplementedError
+
+    # Сохраняет изменения записи и отмечает её как самую свежую
+    def save(self, user_id: int, entry: ConversationEntry) -> None:
+        raise NotImplementedError
+
+    def delete(self, user_id: int) -> None:
+        raise NotImplementedError
+
+    # Удаляет записи, обновлённые раньше deadline
+    def purge(self, deadline: float) -> None:
+        raise NotImplementedError
+
+    # Записывает отложенные изменения; для хранилищ в памяти ничего не делает
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class InMemoryStore(ConversationStore):
+    # Хранит диалоги в памяти процесса; при превышении max_users вытесняет самый давний
+    def __init__(self, max_users: int = 0):
+        self._max_users = max_users
+        # Записи упорядочены по updated_at: самые давние в начале, поэтому очистка и вытеснение не требуют полного обхода
+        self._entries: OrderedDict[int, ConversationEntry] = OrderedDict()
+        # Хранилище используется и из event loop, и из пула потоков INFERENCE_EXECUTOR (локальная модель,
+        # синхронный клиент). Блокировка повторно входимая: ею же пользуется SQLiteStore, где save() и вытеснение вызывают flush()
+        self._lock = threading.RLock()
+
+    def get(self, user_id: int) -> Optional[ConversationEntry]:
+        with self._lock:
+            return self._entries.get(user_id)
+
+    def save(self, user_id: int, entry: ConversationEntry) -> None:
+        with self._lock:
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            if self._max_users > 0:
+                while len(self._entries) > self._max_users:
+                    self._evict(*self._entries.popitem(last=False))
+
+    def delete(self, user_id: int) -> None:
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    # Просматриваем только просроченные записи с начала упорядоченного хранилища
+    def purge(self, deadline: float) -> None:
+        with self._lock:
+            while self._entries:
+                user_id, entry = next(iter(self._entries.items()))
+                if entry.updated_at >= deadline:
+                    break
+                del self._entries[user_id]
+
+    # Вызывается для записи, вытесненной по лимиту
+    def _evict(self, user_id: int, entry: ConversationEntry) -> None:
+        pass
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class SQLiteStore(InMemoryStore):
+    # Хранит диалоги в SQLite (режим WAL), в памяти держит только недавно активных пользователей.
+    # История пользователя читается из базы лениво, при первом обращении, а изменения пишутся пачками.
+    def __init__(self, path: str, max_users: int = 0, write_batch: int = 32):
+        super().__init__(max_users)
+        self._write_batch = max(write_batch, 1)
+        # Блокировка InMemoryStore защищает здесь также соединение с базой и _dirty
+        self._dirty: Dict[int, ConversationEntry] = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "user_id INTEGER PRIMARY KEY, history TEXT NOT NULL, "
+            "token_counts TEXT NOT NULL, updated_at REAL NOT NULL, summary TEXT NOT NULL DEFAULT '')"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at)"
+        )
+        # Базы, созданные до появления сжатия истории, получают колонку summary
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(conversations)")}
+        if "summary" not in columns:
+            self._conn.execute("ALTER TABLE conversations ADD COLUMN summary TEXT NOT NULL DEFAULT ''")
+
+    def get(self, user_id: int) -> Optional[ConversationEntry]:
+        with self._lock:
+            entry = super().get(user_id)
+            if entry is not None:
+                return entry
+
+            row = self._conn.execute(
+                "SELECT history, token_counts, updated_at, summary FROM conversations WHERE user_id = ?",
+                (user_id,),
+            ).fetchone()
+            if row is None:
+                return None
+
+            token_counts = json.loads(row[1])
+            entry = ConversationEntry(
+                history=[Message.from_dict(msg) for msg in json.loads(row[0])],
+                updated_at=row[2],
+                token_counts=token_counts,
+                token_total=sum(token_counts),
+                summary=row[3],
+            )
+            super().save(user_id, entry)
+            return entry
+
+    def save(self, user_id: int, entry: ConversationEntry) -> None:
+        with self._lock:
+            self._dirty[user_id] = entry
+            super().save(user_id, entry)
+            if len(self._dirty) >= self._write_batch:
+                self.flush()
+
+    def delete(self, user_id: int) -> None:
+        with self._lock:
+            super().delete(user_id)
+            self._dirty.pop(user_id, None)
+            self._conn.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+
+    # Просроченные записи удаляются одним запросом по индексу updated_at
+    def purge(self, deadline: float) -> None:
+        with self._lock:
+            super().purge(deadline)
+            self._dirty = {
+                user_id: entry
+                for user_id, entry in self._dirty.items()
+                if entry.updated_at >= deadline
+            }
+            self._conn.execute("DELETE FROM conversations WHERE updated_at < ?", (deadline,))
+
+    # Записывает все накопленные изменения одной транзакцией. Блокировка держится до COMMIT:
+    # иначе get() вытесненной записи успел бы прочитать из базы её старую версию
+    def flush(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+
+            rows = [
+                (
+                    user_id,
+                    json.dumps(to_api_messages(entry.history), ensure_ascii=False),
+                    json.dumps(entry.token_counts),
+                    entry.updated_at,
+                    entry.summary,
+                )
+                for user_id, entry in self._dirty.items()
+            ]
+            self._dirty = {}
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO conversations (user_id, history, token_counts, updated_at, summary) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.execute("COMMIT")
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+    # Вытесненная из памяти запись остаётся в базе, поэтому её несохранённые изменения надо записать
+    def _evict(self, user_id: int, entry: ConversationEntry) -> None:
+        if user_id in self._dirty:
+            self.flush()
+
+
+# Создаёт хранилище диалогов по настройкам конфигурации
+def create_store(config: BotConfig) -> ConversationStore:
+    if config.history_backend == "sqlite":
+        return SQLiteStore(
+            config.history_db_path,
+            max_users=config.history_max_users,
+            write_batch=config.history_write_batch,
+        )
+    if config.history_backend != "memory":
+        raise ValueError(f"Неизвестное хранилище истории: {config.history_backend}")
+    return InMemoryStore(max_users=config.history_max_users)
 
 
 class ConversationManager:
     # Управляет историей диалогов и следит за тем, чтобы история не выходила за лимиты
-    def __init__(self, tokenizer: Optional[PreTrainedTokenizerBase], config: BotConfig):
+    def __init__(
+        self,
+        tokenizer: Optional[PreTrainedTokenizerBase],
+        config: BotConfig,
+        store: Optional[ConversationStore] = None,
+    ):
         self._tokenizer = tokenizer
         self._config = config
-        self._store: Dict[int, ConversationEntry] = {}
+        self._store = store if store is not None else create_store(config)
+        # Накладные токены шаблона (приглашение ассистента и разметка сообщений) считаем один раз
+        self._template_overhead: Optional[int] = None
+        self._message_overhead = 0
+        # Системное сообщение одинаково у всех пользователей: храним один объект и один подсчёт токенов
+        self._system_message = Message("system", config.system_prompt)
+        self._system_tokens: Optional[int] = None
+        if config.token_counter not in ("auto", "estimate", "exact"):
+            raise ValueError(f"Неизвестный способ подсчёта токенов: {config.token_counter}")
+        # Оценка нужна, только если токенайзера нет или она выбрана явно
+        self._estimator: Optional[TokenEstimator] = None
+        if tokenizer is None or config.token_counter == "estimate":
+            self._estimator = TokenEstimator.load(config.model_name)
 
     def _now(self) -> float:
         return time.time()
@@ -54,40 +405,60 @@ class ConversationManager:
         if ttl <= 0:
             return
 
-        current = self._now()
-        inactive = [
-            user_id
-            for user_id, entry in self._store.items()
-            if current - entry.updated_at > ttl
-        ]
-        for user_id in inactive:
-            del self._store[user_id]
+        with HISTORY_PURGE_SECONDS.time():
+            self._store.purge(self._now() - ttl)
             
     # Инициализация хранилища для нового пользователя
     def _ensure_entry(self, user_id: int) -> ConversationEntry:        
         entry = self._store.get(user_id)
         if entry is None:
-            entry = ConversationEntry(
-                history=[{"role": "system", "content": self._config.system_prompt}],
-                updated_at=self._now(),
-            )
-            self._store[user_id] = entry
+            entry = ConversationEntry(updated_at=self._now())
+            if self._system_tokens is None:
+                self._system_tokens = self._count_message_tokens(self._system_message)
+            entry.history.append(self._system_message)
+            entry.token_counts.append(self._system_tokens)
+            entry.token_total = self._system_tokens
+            self._store.save(user_id, entry)
         return entry
 
+    # Записывает отложенные изменения хранилища, например перед остановкой бота
+    def flush(self) -> None:
+        self._store.flush()
+
+    def close(self) -> None:
+        self._store.close()
+
+    # Количество диалогов, которые сейчас держит хранилище
+    def __len__(self) -> int:
+        return len(self._store)
+
+    # Добавляет сообщение в историю и сразу считает его токены, чтобы не токенизировать историю заново
+    def _append_message(self, entry: ConversationEntry, message: Message) -> None:
+        tokens = self._count_message_tokens(message)
+        entry.history.append(message)
+        entry.token_counts.append(tokens)
+        entry.token_total += tokens
+
     # Добавляет реплику пользователя в историю и сокращает историю, если она превысила лимиты
     def add_user_message(self, user_id: int, content: str) -> None:        
-        self.purge_inactive()
+        # При фоновой очистке не тратим на неё время обработки сообщения
+        if self._config.history_purge_interval <= 0:
+            self.purge_inactive()
         entry = self._ensure_entry(user_id)
-        entry.history.append({"role": "user", "content": content})
+        self._append_message(entry, Message("user", content))
         entry.updated_at = self._now()
-        self._truncate_history(entry.history)
+        with HISTORY_TRUNCATE_SECONDS.time():
+            self._truncate_history(entry)
+        self._store.save(user_id, entry)
 
     # Сохраняет ответ модели в ту же историю, чтобы поддерживать контекст
     def add_assistant_message(self, user_id: int, content: str) -> None:
         entry = self._ensure_entry(user_id)
-        entry.history.append({"role": "assistant", "content": content})
+        self._append_message(entry, Message("assistant", content))
         entry.updated_at = self._now()
-        self._truncate_history(entry.history)
+        with HISTORY_TRUNCATE_SECONDS.time():
+            self._truncate_history(entry)
+        self._store.save(user_id, entry)
         
     # Формируем промпт в формате токенайзера либо в простом текстовом виде
     def build_prompt(self, user_id: int, add_generation_prompt: bool = True) -> str:
@@ -96,7 +467,7 @@ class ConversationManager:
 
         if self._tokenizer and hasattr(self._tokenizer, "apply_chat_template"):
             return self._tokenizer.apply_chat_template(
-                history,
+                to_api_messages(history),
                 tokenize=False,
                 add_generation_prompt=add_generation_prompt,
             )
@@ -115,51 +486,149 @@ class ConversationManager:
 
         return "".join(prompt_parts)
 
-    # Возвращает копию текущей истории, чтобы вызывающий код не мог испортить оригинал
-    def get_history(self, user_id: int) -> List[ChatMessage]:
-        return list(self._ensure_entry(user_id).history)
+    # Возвращает историю только для чтения без копирования; в формат API её переводит to_api_messages
+    def get_history(self, user_id: int) -> HistoryView:
+        return HistoryView(self._ensure_entry(user_id).history)
 
     # Полностью удаляет историю пользователя, например по команде /clear
     def clear_history(self, user_id: int) -> None:
-        if user_id in self._store:
-            del self._store[user_id]
+        self._store.delete(user_id)
+
+    # Запрос к модели на обновление краткого содержания и реплики, которые в него войдут; None - сжимать нечего
+    def build_summary_request(self, user_id: int) -> Optional[Tuple[List[ChatMessage], List[Message]]]:
+        entry = self._store.get(user_id)
+        if entry is None or not entry.evicted:
+            return None
+
+        turns = list(entry.evicted)
+        parts: List[str] = []
+        # Краткое содержание обновляется инкрементально: модели передаём прежнее и только новые реплики
+        if entry.summary:
+            parts.append(f"Текущее краткое содержание:\n{entry.summary}")
+        parts.append("Новые реплики:\n" + "\n".join(f"{msg.role}: {msg.content}" for msg in turns))
+        messages = [
+            {"role": "system", "content": self._config.history_summary_prompt},
+            {"role": "user", "content": "\n\n".join(parts)},
+        ]
+        return messages, turns
+
+    # Сохраняет новое краткое содержание и убирает вошедшие в него реплики из очереди на сжатие
+    def apply_summary(self, user_id: int, summary: str, turns: List[Message]) -> bool:
+        entry = self._store.get(user_id)
+        # История могла быть очищена или пересоздана, пока модель готовила краткое содержание
+        if entry is None or len(entry.evicted) < len(turns):
+            return False
+        if any(current is not taken for current, taken in zip(entry.evicted, turns)):
+            return False
+
+        del entry.evicted[:len(turns)]
+        entry.summary = summary
+        self._set_system_message(entry)
+        with HISTORY_TRUNCATE_SECONDS.time():
+            self._truncate_history(entry)
+        self._store.save(user_id, entry)
+        return True
+
+    # Краткое содержание дописывается к системному сообщению, поэтому структура истории не меняется
+    def _set_system_message(self, entry: ConversationEntry) -> None:
+        if entry.summary:
+            message = Message(
+                "system",
+                f"{self._config.system_prompt}\n\nКраткое содержание предыдущей части диалога:\n{entry.summary}",
+            )
+            tokens = self._count_message_tokens(message)
+        else:
+            message = self._system_message
+            tokens = self._system_tokens or self._count_message_tokens(message)
+        entry.token_total += tokens - entry.token_counts[0]
+        entry.history[0] = message
+        entry.token_counts[0] = tokens
+
+    # Вытесненные реплики копятся для сжатия, если оно включено, иначе просто отбрасываются
+    def _evict_messages(self, entry: ConversationEntry, messages: List[Message]) -> None:
+        if not self._config.history_summarize:
+            return
+        entry.evicted.extend(messages)
+        if len(entry.evicted) > SUMMARY_MAX_PENDING:
+            del entry.evicted[:-SUMMARY_MAX_PENDING]
 
     # Ограничивает количество пар user/assistant в истории
-    def _truncate_history(self, history: List[ChatMessage]) -> None:
+    def _truncate_history(self, entry: ConversationEntry) -> None:
+        history = entry.history
+        counts = entry.token_counts
         max_pairs = self._config.history_max_pairs
         if max_pairs > 0:
 
             max_messages = 1 + max_pairs * 2
             if len(history) > max_messages:
                 # Сохраняем системное сообщение и последние пары user/assistant
-                system = history[0]
-                history[:] = [system] + history[-(max_messages - 1):]
+                keep = max_messages - 1
+                self._evict_messages(entry, history[1:-keep])
+                history[:] = history[:1] + history[-keep:]
+                counts[:] = counts[:1] + counts[-keep:]
+                entry.token_total = sum(counts)
 
         # Ограничиваем количество токенов в истории
         max_tokens = self._config.history_max_tokens
         if max_tokens <= 0:
             return
 
-        while len(history) > 1:
-            prompt = self.build_prompt_from_history(history)
-            token_count = self._count_tokens(prompt)
-            if token_count <= max_tokens:
-                break
-            # Удаляем самую старую пару user/assistant (если есть)
-            if len(history) > 2:
-                del history[1:3]
-            else:
-                break
+        # Токены сообщений уже посчитаны, поэтому сокращение сводится к арифметике над суммой
+        overhead = self._get_template_overhead()
+        while len(history) > 2 and overhead + entry.token_total > max_tokens:
+            # Удаляем самую старую пару user/assistant
+            entry.token_total -= counts[1] + counts[2]
+            self._evict_messages(entry, history[1:3])
+            del history[1:3]
+            del counts[1:3]
+
+    # Возвращает текстовое представление одного сообщения в простом формате промпта
+    @staticmethod
+    def _render_message(message: Union[Message, ChatMessage]) -> str:
+        role = message["role"]
+        if role in ("system", "user", "assistant"):
+            return f"<|{role}|>\n{message['content']}\n"
+        return ""
+
+    # Считает токены одного сообщения вместе с разметкой, которую шаблон добавляет вокруг него
+    def _count_message_tokens(self, message: Union[Message, ChatMessage]) -> int:
+        if self._tokenizer and hasattr(self._tokenizer, "apply_chat_template"):
+            self._ensure_template_overhead()
+            return self._count_tokens(message["content"]) + self._message_overhead
+        return self._count_tokens(self._render_message(message))
+
+    # Возвращает токены, которые шаблон добавляет поверх сообщений (приглашение ассистента и т.п.)
+    def _get_template_overhead(self) -> int:
+        self._ensure_template_overhead()
+        return self._template_overhead or 0
+
+    # Один раз измеряет разметку шаблона: общую часть и добавку на каждое сообщение
+    def _ensure_template_overhead(self) -> None:
+        if self._template_overhead is not None:
+            return
+
+        if self._tokenizer and hasattr(self._tokenizer, "apply_chat_template"):
+            system = {"role": "system", "content": self._config.system_prompt}
+            user = {"role": "user", "content": "."}
+            content_one = self._count_tokens(system["content"])
+            content_two = content_one + self._count_tokens(user["content"])
+            markup_one = self._count_tokens(self.build_prompt_from_history([system])) - content_one
+            markup_two = self._count_tokens(self.build_prompt_from_history([system, user])) - content_two
+            self._message_overhead = max(markup_two - markup_one, 0)
+            self._template_overhead = max(markup_one - self._message_overhead, 0)
+        else:
+            self._message_overhead = 0
+            self._template_overhead = self._count_tokens("<|assistant|>\n")
 
     # Собирает промпт из уже подготовленной истории
     def build_prompt_from_history(
         self,
-        history: List[ChatMessage],
+        history: Sequence[Union[Message, ChatMessage]],
         add_generation_prompt: bool = True,
     ) -> str:
         if self._tokenizer and hasattr(self._tokenizer, "apply_chat_template"):
             return self._tokenizer.apply_chat_template(
-                history,
+                to_api_messages(history),
                 tokenize=False,
                 add_generation_prompt=add_generation_prompt,
             )
@@ -178,12 +647,13 @@ class ConversationManager:
 
         return "".join(prompt_parts)
 
-    # Подсчитываем токены через реальный токенайзер, либо делим строку по пробелам, если токенайзер не передан
+    # Подсчитываем токены реальным токенайзером, если он есть (локальная модель или token_counter=exact),
+    # иначе быстрой оценкой; token_counter=estimate всегда выбирает оценку
     def _count_tokens(self, prompt: str) -> int:
         if not prompt:
             return 0
 
-        if self._tokenizer:
+        if self._tokenizer and self._config.token_counter != "estimate":
             encoded = self._tokenizer(
                 prompt,
                 add_special_tokens=False,
@@ -197,5 +667,5 @@ class ConversationManager:
 
             return len(input_ids)
 
-        return len(prompt.split())
+        return self._estimator.count(prompt)
 
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import importlib.util
+import logging
+from typing import Any
+
+from conversation_utils import BotConfig
+from metrics import HTTP_CONNECTIONS, HTTP_POOL_SIZE, HTTP_REQUESTS, HTTP_TLS_HANDSHAKES
+
+logger = logging.getLogger(__name__)
+
+
+# Размер пула: явный http_pool_size, иначе столько, сколько запросов к модели может идти одновременно
+def pool_size(config: BotConfig) -> int:
+    if config.http_pool_size > 0:
+        return config.http_pool_size
+    if config.max_concurrent_requests > 0:
+        size = config.max_concurrent_requests
+    elif config.use_async_client:
+        size = config.concurrent_updates
+    else:
+        size = config.inference_threads
+    # Дублирующий запрос занимает второе соединение, пока не завершится первый
+    if config.inference_hedge:
+        size *= 2
+    return max(size, 1)
+
+
+# Трассировка httpcore: новое TCP-соединение и TLS-рукопожатие появляются только тогда,
+# когда в пуле не нашлось свободного keep-alive соединения
+def _trace(event: str, info: dict) -> None:
+    if event == "connection.connect_tcp.complete":
+        HTTP_CONNECTIONS.inc()
+    elif event == "connection.start_tls.complete":
+        HTTP_TLS_HANDSHAKES.inc()
+
+
+async def _async_trace(event: str, info: dict) -> None:
+    _trace(event, info)
+
+
+def _count_request(request: Any) -> None:
+    HTTP_REQUESTS.inc()
+    request.extensions["trace"] = _trace
+
+
+async def _async_count_request(request: Any) -> None:
+    HTTP_REQUESTS.inc()
+    request.extensions["trace"] = _async_trace
+
+
+# Настраивает HTTP-клиенты huggingface_hub: один пул соединений с keep-alive для синхронного пути
+# (общий для всех InferenceClient) и такой же пул у каждого AsyncInferenceClient.
+# Вызывается до создания клиентов; для huggingface_hub без httpx ничего не делает
+def configure_http_pool(config: BotConfig) -> None:
+    import huggingface_hub
+
+    if not hasattr(huggingface_hub, "set_client_factory"):
+        logger.warning("Версия huggingface_hub не поддерживает настройку HTTP-клиента, использую пул по умолчанию.")
+        return
+
+    import httpx2
+    from huggingface_hub.utils._http import (
+        async_hf_request_event_hook,
+        async_hf_response_event_hook,
+        hf_request_event_hook,
+    )
+
+    size = pool_size(config)
+    limits = httpx2.Limits(
+        max_connections=size,
+        # Все соединения пула остаются открытыми между запросами, иначе после всплеска нагрузки
+        # лишние закрываются и следующий всплеск снова платит за TCP и TLS
+        max_keepalive_connections=size,
+        keepalive_expiry=config.http_keepalive_expiry or None,
+    )
+    http2 = config.http2
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("HTTP2 требует пакет h2 (pip install 'httpx[http2]'), использую HTTP/1.1.")
+        http2 = False
+
+    def client_factory() -> httpx2.Client:
+        return httpx2.Client(
+            event_hooks={"request": [hf_request_event_hook, _count_request]},
+            follow_redirects=True,
+            timeout=None,
+            limits=limits,
+            http2=http2,
+        )
+
+    def async_client_factory() -> httpx2.AsyncClient:
+        return httpx2.AsyncClient(
+            event_hooks={
+                "request": [async_hf_request_event_hook, _async_count_request],
+                "response": [async_hf_response_event_hook],
+            },
+            follow_redirects=True,
+            timeout=None,
+            limits=limits,
+            http2=http2,
+        )
+
+    huggingface_hub.set_client_factory(client_factory)
+    huggingface_hub.set_async_client_factory(async_client_factory)
+    HTTP_POOL_SIZE.set(size)
+    logger.info(
+        "HTTP-пул клиента модели: до %s соединений, keep-alive %s с%s.",
+        size,
+        config.http_keepalive_expiry,
+        ", HTTP/2" if http2 else "",
+    )
+
+
+# Доля запросов, ушедших по уже открытому соединению
+def connection_stats() -> dict:
+    requests = int(HTTP_REQUESTS.value)
+    connections = int(HTTP_CONNECTIONS.value)
+    return {
+        "requests": requests,
+        "connections": connections,
+        "tls_handshakes": int(HTTP_TLS_HANDSHAKES.value),
+        "reuse_ratio": round(1 - connections / requests, 3) if requests else None,
+    }
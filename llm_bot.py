@@ -1,30 +1,59 @@
+from __future__ import annotations
+
 import asyncio
 import logging
 import os
-import re
-
-from huggingface_hub import InferenceClient
-from telegram import Update
-from telegram.constants import ChatAction
-from telegram.ext import (
-    ApplicationBuilder,
-    CommandHandler,
-    ContextTypes,
-    MessageHandler,
-    filters,
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack, aclosing
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Optional, Tuple
+
+from admission import AdmissionController, Overloaded
+from conversation_utils import BotConfig, ChatMessage, ConversationManager, to_api_messages
+from metrics import (
+    EXECUTOR_BUSY_THREADS,
+    EXECUTOR_QUEUE_LENGTH,
+    EXECUTOR_QUEUE_SECONDS,
+    EXECUTOR_THREADS,
+    HISTORY_SUMMARY_ERRORS,
+    HISTORY_SUMMARY_SECONDS,
+    INFERENCE_ERRORS,
+    INFERENCE_SECONDS,
+    STORE_SIZE,
+    STREAM_EARLY_STOPS,
+    TELEGRAM_SEND_SECONDS,
+    TOKENS_IN,
+    TOKENS_OUT,
+    start_metrics_server,
 )
+from backend_pool import BackendPool
+from http_pool import configure_http_pool, connection_stats
+from resilience import RetryPolicy
+from response_cache import ResponseCache, is_cacheable
+from think_filter import ThinkFilter, strip_think
 
-from conversation_utils import BotConfig, ConversationManager
+# telegram и huggingface_hub импортируются при создании приложения, чтобы импорт модуля оставался быстрым
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import Application, ContextTypes
 
 # Настраиваем минимальный уровень логирования, чтобы видеть, что происходит на работающем боте
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Максимальная длина текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
 # Читаем конфигурацию из окружения, чтобы легко менять параметры без правок кода
 def load_config() -> BotConfig:
     telegram_token = os.environ.get("TELEGRAM_TOKEN", "YOUR_BOT_TOKEN").strip()
     model_name = os.environ.get("HF_MODEL_NAME", "HuggingFaceTB/SmolLM3-3B").strip()
     hf_token = os.environ.get("HF_TOKEN", "YOUR_HF_TOKEN").strip()
+    hf_base_url = os.environ.get("HF_BASE_URL", "").strip()
+    inference_backends = [spec.strip() for spec in os.environ.get("INFERENCE_BACKENDS", "").split(",") if spec.strip()]
+    balance_strategy = os.environ.get("BALANCE_STRATEGY", "least_outstanding").strip().lower()
+    breaker_failures = int(os.environ.get("BREAKER_FAILURES", "5"))
+    breaker_cooldown = float(os.environ.get("BREAKER_COOLDOWN", "30"))
     system_prompt = os.environ.get(
         "SYSTEM_PROMPT",
         "Ты - полезный ассистент. Отвечай на русском языке.",
@@ -36,12 +65,66 @@ def load_config() -> BotConfig:
     history_max_pairs = int(os.environ.get("HISTORY_MAX_PAIRS", "4"))
     history_max_tokens = int(os.environ.get("HISTORY_MAX_TOKENS", "2048"))
     history_ttl_seconds = int(os.environ.get("HISTORY_TTL_SECONDS", "3600"))
+    history_max_users = int(os.environ.get("HISTORY_MAX_USERS", "0"))
+    history_purge_interval = float(os.environ.get("HISTORY_PURGE_INTERVAL", "0"))
+    history_backend = os.environ.get("HISTORY_BACKEND", "memory").strip().lower()
+    history_db_path = os.environ.get("HISTORY_DB_PATH", "conversations.sqlite3").strip()
+    history_write_batch = int(os.environ.get("HISTORY_WRITE_BATCH", "32"))
+    history_flush_interval = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "5"))
+    token_counter = os.environ.get("TOKEN_COUNTER", "auto").strip().lower()
+    history_summarize = os.environ.get("HISTORY_SUMMARIZE", "0").strip().lower() in ("1", "true", "yes")
+    history_summary_max_tokens = int(os.environ.get("HISTORY_SUMMARY_MAX_TOKENS", "256"))
     model_device = os.environ.get("MODEL_DEVICE", "auto").lower()
+    inference_backend = os.environ.get("INFERENCE_BACKEND", "remote").strip().lower()
+    local_quantize_int8 = os.environ.get("LOCAL_QUANTIZE_INT8", "0").strip().lower() in ("1", "true", "yes")
+    local_threads = int(os.environ.get("LOCAL_THREADS", "0"))
+    local_batch_size = int(os.environ.get("LOCAL_BATCH_SIZE", "1"))
+    local_batch_wait_ms = float(os.environ.get("LOCAL_BATCH_WAIT_MS", "20"))
+    local_prefix_cache_mb = int(os.environ.get("LOCAL_PREFIX_CACHE_MB", "0"))
+    local_system_prompt_cache = os.environ.get("LOCAL_SYSTEM_PROMPT_CACHE", "1").strip().lower() not in ("0", "false", "no")
+    use_async_client = os.environ.get("USE_ASYNC_CLIENT", "1").strip().lower() not in ("0", "false", "no")
+    inference_threads = int(os.environ.get("INFERENCE_THREADS", "8"))
+    inference_timeout = float(os.environ.get("INFERENCE_TIMEOUT", "60"))
+    inference_retries = int(os.environ.get("INFERENCE_RETRIES", "2"))
+    retry_backoff = float(os.environ.get("RETRY_BACKOFF", "0.5"))
+    retry_backoff_max = float(os.environ.get("RETRY_BACKOFF_MAX", "10"))
+    inference_hedge = os.environ.get("INFERENCE_HEDGE", "0").strip().lower() in ("1", "true", "yes")
+    inference_hedge_percentile = float(os.environ.get("INFERENCE_HEDGE_PERCENTILE", "95"))
+    http_pool_size = int(os.environ.get("HTTP_POOL_SIZE", "0"))
+    http_keepalive_expiry = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "30"))
+    http2 = os.environ.get("HTTP2", "0").strip().lower() in ("1", "true", "yes")
+    stream_replies = os.environ.get("STREAM_REPLIES", "0").strip().lower() in ("1", "true", "yes")
+    stream_edit_interval = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.0"))
+    response_cache_size = int(os.environ.get("RESPONSE_CACHE_SIZE", "0"))
+    response_cache_ttl = int(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+    response_cache_first_turns = os.environ.get("RESPONSE_CACHE_FIRST_TURNS", "0").strip().lower() in ("1", "true", "yes")
+    max_concurrent_requests = int(os.environ.get("MAX_CONCURRENT_REQUESTS", "0"))
+    max_queued_requests = int(os.environ.get("MAX_QUEUED_REQUESTS", "100"))
+    queue_timeout = float(os.environ.get("QUEUE_TIMEOUT", "30"))
+    user_rate_limit = int(os.environ.get("USER_RATE_LIMIT", "0"))
+    user_rate_period = float(os.environ.get("USER_RATE_PERIOD", "60"))
+    update_mode = os.environ.get("UPDATE_MODE", "polling").strip().lower()
+    concurrent_updates = int(os.environ.get("CONCURRENT_UPDATES", "256"))
+    telegram_api_url = os.environ.get("TELEGRAM_API_URL", "").strip()
+    webhook_url = os.environ.get("WEBHOOK_URL", "").strip()
+    webhook_listen = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0").strip()
+    webhook_port = int(os.environ.get("WEBHOOK_PORT", "8443"))
+    webhook_path = os.environ.get("WEBHOOK_PATH", "telegram").strip()
+    webhook_secret = os.environ.get("WEBHOOK_SECRET", "").strip()
+    webhook_drain_timeout = float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "30"))
+    metrics_port = int(os.environ.get("METRICS_PORT", "0"))
+    metrics_listen = os.environ.get("METRICS_LISTEN", "127.0.0.1").strip()
+    workers = int(os.environ.get("WORKERS", "1"))
 
     return BotConfig(
         telegram_token=telegram_token,
         hf_token=hf_token,
         model_name=model_name,
+        hf_base_url=hf_base_url,
+        inference_backends=inference_backends,
+        balance_strategy=balance_strategy,
+        breaker_failures=breaker_failures,
+        breaker_cooldown=breaker_cooldown,
         system_prompt=system_prompt,
         max_new_tokens=max_new_tokens,
         temperature=temperature,
@@ -50,71 +133,411 @@ def load_config() -> BotConfig:
         history_max_pairs=history_max_pairs,
         history_max_tokens=history_max_tokens,
         history_ttl_seconds=history_ttl_seconds,
+        history_max_users=history_max_users,
+        history_purge_interval=history_purge_interval,
+        history_backend=history_backend,
+        history_db_path=history_db_path,
+        history_write_batch=history_write_batch,
+        history_flush_interval=history_flush_interval,
+        token_counter=token_counter,
+        history_summarize=history_summarize,
+        history_summary_max_tokens=history_summary_max_tokens,
         model_device=model_device,
+        inference_backend=inference_backend,
+        local_quantize_int8=local_quantize_int8,
+        local_threads=local_threads,
+        local_batch_size=local_batch_size,
+        local_batch_wait_ms=local_batch_wait_ms,
+        local_prefix_cache_mb=local_prefix_cache_mb,
+        local_system_prompt_cache=local_system_prompt_cache,
+        use_async_client=use_async_client,
+        inference_threads=inference_threads,
+        inference_timeout=inference_timeout,
+        inference_retries=inference_retries,
+        retry_backoff=retry_backoff,
+        retry_backoff_max=retry_backoff_max,
+        inference_hedge=inference_hedge,
+        inference_hedge_percentile=inference_hedge_percentile,
+        http_pool_size=http_pool_size,
+        http_keepalive_expiry=http_keepalive_expiry,
+        http2=http2,
+        stream_replies=stream_replies,
+        stream_edit_interval=stream_edit_interval,
+        response_cache_size=response_cache_size,
+        response_cache_ttl=response_cache_ttl,
+        response_cache_first_turns=response_cache_first_turns,
+        max_concurrent_requests=max_concurrent_requests,
+        max_queued_requests=max_queued_requests,
+        queue_timeout=queue_timeout,
+        user_rate_limit=user_rate_limit,
+        user_rate_period=user_rate_period,
+        update_mode=update_mode,
+        concurrent_updates=concurrent_updates,
+        telegram_api_url=telegram_api_url,
+        webhook_url=webhook_url,
+        webhook_listen=webhook_listen,
+        webhook_port=webhook_port,
+        webhook_path=webhook_path,
+        webhook_secret=webhook_secret,
+        webhook_drain_timeout=webhook_drain_timeout,
+        metrics_port=metrics_port,
+        metrics_listen=metrics_listen,
+        workers=workers,
     )
 
 
-CONFIG = load_config()
+# Клиенты, пулы и хранилище создаёт init_services при запуске, а не импорт модуля
+CONFIG: Optional[BotConfig] = None
+BOT_TOKEN = ""
+BACKENDS: Optional[BackendPool] = None
+INFERENCE_EXECUTOR: Optional[ThreadPoolExecutor] = None
+LOCAL_GENERATOR = None
+BATCH_SCHEDULER = None
+TOKENIZER = None
+conversation_manager: Optional[ConversationManager] = None
+RESPONSE_CACHE: Optional[ResponseCache] = None
+ADMISSION: Optional[AdmissionController] = None
+RETRY_POLICY: Optional[RetryPolicy] = None
+
+
+# Создаёт всё, что нужно для обработки сообщений; повторный вызов ничего не делает
+def init_services(config: Optional[BotConfig] = None) -> BotConfig:
+    global CONFIG, BOT_TOKEN, BACKENDS, INFERENCE_EXECUTOR, LOCAL_GENERATOR, BATCH_SCHEDULER
+    global TOKENIZER, conversation_manager, RESPONSE_CACHE, ADMISSION, RETRY_POLICY
+
+    if CONFIG is not None:
+        return CONFIG
+    config = config or load_config()
+
+    if config.hf_token == "YOUR_HF_TOKEN" or not config.hf_token:
+        logger.warning("HF_TOKEN не задан. Будет выполнена попытка скачать публичную модель без токена.")
+
+    if config.telegram_token == "YOUR_BOT_TOKEN" or not config.telegram_token:
+        raise RuntimeError("TELEGRAM_TOKEN не задан. Установите переменную окружения TELEGRAM_TOKEN.")
+
+    BOT_TOKEN = config.telegram_token
+
+    # Пул HTTP-соединений настраивается до создания клиентов: синхронный и асинхронный путь держат соединения открытыми
+    if config.inference_backend != "local":
+        configure_http_pool(config)
+
+    # Клиенты Hugging Face создаются один раз на каждый бэкенд пула, чтобы не открывать соединения лишний раз
+    BACKENDS = BackendPool(config)
+    RETRY_POLICY = RetryPolicy(config)
+
+    # Отдельный пул для блокирующей генерации: его размер не зависит от пула по умолчанию, которым пользуется python-telegram-bot
+    INFERENCE_EXECUTOR = ThreadPoolExecutor(max_workers=config.inference_threads, thread_name_prefix="inference")
+    EXECUTOR_THREADS.set(config.inference_threads)
+
+    # Локальная модель загружается только по явному выбору: её токенайзер используется для подсчёта токенов и промпта
+    if config.inference_backend == "local":
+        from local_inference import LocalGenerator
+
+        LOCAL_GENERATOR = LocalGenerator(config)
+        logger.info("Использую локальную модель %s (%s).", config.model_name, LOCAL_GENERATOR.device)
+    else:
+        logger.info("Использую модель %s через Hugging Face Inference API.", config.model_name)
 
-if CONFIG.hf_token == "YOUR_HF_TOKEN" or not CONFIG.hf_token:
-    logger.warning("HF_TOKEN не задан. Будет выполнена попытка скачать публичную модель без токена.")
+    # Пакетная генерация: запросы разных пользователей, пришедшие почти одновременно, считаются одним model.generate
+    if LOCAL_GENERATOR is not None and config.local_batch_size > 1:
+        from local_inference import BatchScheduler
 
-if CONFIG.telegram_token == "YOUR_BOT_TOKEN" or not CONFIG.telegram_token:
-    raise RuntimeError("TELEGRAM_TOKEN не задан. Установите переменную окружения TELEGRAM_TOKEN.")
+        BATCH_SCHEDULER = BatchScheduler(
+            LOCAL_GENERATOR,
+            INFERENCE_EXECUTOR,
+            max_batch_size=config.local_batch_size,
+            max_wait=config.local_batch_wait_ms / 1000,
+        )
+
+    # Для точного подсчёта токенов без локальной модели загружаем только её токенайзер
+    if LOCAL_GENERATOR is not None:
+        TOKENIZER = LOCAL_GENERATOR.tokenizer
+    elif config.token_counter == "exact":
+        from transformers import AutoTokenizer
 
-BOT_TOKEN = CONFIG.telegram_token
+        TOKENIZER = AutoTokenizer.from_pretrained(config.model_name, token=config.hf_token or None)
 
-# Используем один клиент Hugging Face на весь процесс, чтобы не открывать соединения лишний раз
-CLIENT = InferenceClient(token=CONFIG.hf_token or None)
+    # ConversationManager хранит историю диалогов и следит за лимитами токенов
+    conversation_manager = ConversationManager(tokenizer=TOKENIZER, config=config)
+    STORE_SIZE.set_function(lambda: len(conversation_manager))
 
-logger.info("Использую модель %s через Hugging Face Inference API.", CONFIG.model_name)
+    # Кэш повторяющихся ответов, чтобы не платить за одинаковые запросы к модели
+    RESPONSE_CACHE = ResponseCache(config.response_cache_size, config.response_cache_ttl)
 
-# ConversationManager хранит историю диалогов и следит за лимитами токенов
-conversation_manager = ConversationManager(tokenizer=None, config=CONFIG)
+    # Ограничение одновременных запросов к модели: при перегрузке пользователь сразу получает отказ, а не ждёт таймаута
+    ADMISSION = AdmissionController(config)
 
-# Очищаем ответ от тегов <think>, которые модель добавляет в ответах
+    CONFIG = config
+    return config
+
+# Очищаем ответ от тегов <think>, которые модель добавляет в ответах; незакрытый блок рассуждений тоже срезается
 def _clean_model_output(text: str) -> str:
 
-    if "<think>" not in text.lower():
+    if "<" not in text:
         return text
 
-    cleaned = re.sub(r"<think>.*?</think>", "", text, flags=re.IGNORECASE | re.DOTALL)
-    return cleaned.strip()
+    return strip_think(text)
+
+# Достаём текст ответа из результата chat-completion (объект или словарь)
+def _extract_content(completion) -> str:
+    content = ""
+    if completion.choices:
+        message_obj = completion.choices[0].message  
+        if isinstance(message_obj, dict):
+            content = message_obj.get("content", "") or ""
+        else:
+            content = getattr(message_obj, "content", "") or ""
+    return _clean_model_output(content.strip())
+
+# Учитываем токены запроса и ответа, если API вернул статистику usage
+def _record_usage(completion) -> None:
+    usage = getattr(completion, "usage", None)
+    if usage is None:
+        return
+    TOKENS_IN.inc(getattr(usage, "prompt_tokens", 0) or 0)
+    TOKENS_OUT.inc(getattr(usage, "completion_tokens", 0) or 0)
+
+# Одна попытка chat-completion на бэкенде, который выбрал пул (синхронный путь, таймаут задаёт клиент)
+def _create_completion(messages: List[ChatMessage], max_tokens: int):
+    with BACKENDS.lease() as backend:
+        return backend.client.chat.completions.create(
+            model=backend.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=CONFIG.temperature,
+            top_p=CONFIG.top_p,
+        )
+
+# Одна попытка асинхронного chat-completion; при stream=True пул учитывает только время до начала ответа
+async def _create_completion_async(messages: List[ChatMessage], max_tokens: int):
+    with BACKENDS.lease() as backend:
+        return await RETRY_POLICY.with_timeout(
+            backend.async_client.chat.completions.create(
+                model=backend.model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=CONFIG.temperature,
+                top_p=CONFIG.top_p,
+            )
+        )
+
+# Открываем потоковый ответ модели; он закрывается вместе со stack, и соединение возвращается в пул
+async def _open_stream(messages: List[ChatMessage], stack: AsyncExitStack):
+    with BACKENDS.lease() as backend:
+        return await RETRY_POLICY.with_timeout(
+            stack.enter_async_context(
+                backend.stream_chat(
+                    messages,
+                    max_tokens=CONFIG.max_new_tokens,
+                    temperature=CONFIG.temperature,
+                    top_p=CONFIG.top_p,
+                )
+            )
+        )
+
+# Сохраняем ответ в историю или возвращаем текст ошибки, если модель ничего не вернула
+def _finalize_response(user_id: int, response: str) -> str:
+    if response:
+        # Ответ тоже кладем в историю, чтобы поддерживать контекст диалога
+        conversation_manager.add_assistant_message(user_id, response)
+        return response
+
+    return "Извините, не удалось обработать запрос."
+
+# Ключ кэша для текущей истории или None, если кэшировать такой запрос небезопасно
+def _response_cache_key(messages: List[ChatMessage]) -> Optional[str]:
+    if not is_cacheable(messages, CONFIG):
+        return None
+    return ResponseCache.make_key(messages, CONFIG)
+
+# Кладём удачный ответ в кэш
+def _store_cached_response(cache_key: Optional[str], response: str) -> None:
+    if cache_key is not None and response:
+        RESPONSE_CACHE.put(cache_key, response)
 
 # Генерируем ответ для конкретного пользователя
 def generate_response(user_id: int, user_message: str) -> str:
 
     # Сохраняем пользовательское сообщение в историю до обращения к модели
     conversation_manager.add_user_message(user_id, user_message)
-    messages = conversation_manager.get_history(user_id)
+    messages = to_api_messages(conversation_manager.get_history(user_id))
+
+    cache_key = _response_cache_key(messages)
+    cached = RESPONSE_CACHE.get(cache_key) if cache_key else None
+    if cached:
+        return _finalize_response(user_id, cached)
 
     try:
-        # Выполняем запрос к HF Inference API
-        completion = CLIENT.chat.completions.create(
-            model=CONFIG.model_name,
-            messages=messages,
-            max_tokens=CONFIG.max_new_tokens,
-            temperature=CONFIG.temperature,
-            top_p=CONFIG.top_p,
-        )
-        content = ""
-        if completion.choices:
-            message_obj = completion.choices[0].message  
-            if isinstance(message_obj, dict):
-                content = message_obj.get("content", "") or ""
-            else:
-                content = getattr(message_obj, "content", "") or ""
-        response = _clean_model_output(content.strip())
+        if LOCAL_GENERATOR is not None:
+            # Локальная модель получает промпт в формате её собственного чат-шаблона
+            prompt = conversation_manager.build_prompt(user_id)
+            with INFERENCE_SECONDS.time():
+                content = LOCAL_GENERATOR.generate(prompt, cache_key=user_id)
+            response = _clean_model_output(content.strip())
+        else:
+            # Выполняем запрос к HF Inference API
+            with INFERENCE_SECONDS.time():
+                completion = RETRY_POLICY.call_sync(lambda: _create_completion(messages, CONFIG.max_new_tokens))
+            _record_usage(completion)
+            response = _extract_content(completion)
     except Exception as exc:
+        INFERENCE_ERRORS.inc()
         logger.exception("Ошибка при запросе к Hugging Face Inference API: %s", exc)
         return "Извините, не удалось обработать запрос."
 
-    if response:
-        # Ответ тоже кладем в историю, чтобы поддерживать контекст диалога
-        conversation_manager.add_assistant_message(user_id, response)
-        return response
+    _store_cached_response(cache_key, response)
+    return _finalize_response(user_id, response)
 
-    return "Извините, не удалось обработать запрос."
+# Обёртка для пула потоков: замеряет, сколько задача ждала свободного потока
+def _generate_response_queued(user_id: int, user_message: str, queued_at: float) -> str:
+    EXECUTOR_QUEUE_SECONDS.observe(time.perf_counter() - queued_at)
+    EXECUTOR_QUEUE_LENGTH.dec()
+    EXECUTOR_BUSY_THREADS.inc()
+    try:
+        return generate_response(user_id, user_message)
+    finally:
+        EXECUTOR_BUSY_THREADS.dec()
+
+# Отправляем синхронную генерацию в пул INFERENCE_EXECUTOR
+async def run_generate_response_in_executor(user_id: int, user_message: str) -> str:
+    loop = asyncio.get_running_loop()
+    EXECUTOR_QUEUE_LENGTH.inc()
+    return await loop.run_in_executor(
+        INFERENCE_EXECUTOR, _generate_response_queued, user_id, user_message, time.perf_counter()
+    )
+
+# Асинхронный вариант generate_response: запрос к модели (или к планировщику пакетов локальной модели)
+# ожидается в event loop без отдельного потока
+async def generate_response_async(user_id: int, user_message: str) -> str:
+    conversation_manager.add_user_message(user_id, user_message)
+    messages = to_api_messages(conversation_manager.get_history(user_id))
+
+    cache_key = _response_cache_key(messages)
+    cached = RESPONSE_CACHE.get(cache_key) if cache_key else None
+    if cached:
+        return _finalize_response(user_id, cached)
+
+    try:
+        if BATCH_SCHEDULER is not None:
+            # Локальная модель: промпт попадает в ближайший пакет планировщика
+            prompt = conversation_manager.build_prompt(user_id)
+            with INFERENCE_SECONDS.time():
+                content = await BATCH_SCHEDULER.generate(prompt, cache_key=user_id)
+            response = _clean_model_output(content.strip())
+        else:
+            with INFERENCE_SECONDS.time():
+                completion = await RETRY_POLICY.call(
+                    lambda: _create_completion_async(messages, CONFIG.max_new_tokens)
+                )
+            _record_usage(completion)
+            response = _extract_content(completion)
+    except Exception as exc:
+        INFERENCE_ERRORS.inc()
+        logger.exception("Ошибка при запросе к Hugging Face Inference API: %s", exc)
+        return "Извините, не удалось обработать запрос."
+
+    _store_cached_response(cache_key, response)
+    return _finalize_response(user_id, response)
+
+# Отдаём фрагменты текста по мере генерации (stream=True в chat-completion API)
+async def _stream_completion(messages) -> AsyncIterator[str]:
+    started = time.perf_counter()
+    try:
+        # Ответ закрывается при выходе из stack, в том числе когда поток остановлен досрочно
+        async with AsyncExitStack() as stack:
+            # Повторяется только открытие потока: после первого фрагмента пользователь уже видит ответ
+            stream = await RETRY_POLICY.call(lambda: _open_stream(messages, stack), hedge=False)
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                content = delta.get("content") if isinstance(delta, dict) else getattr(delta, "content", None)
+                if content:
+                    # В потоковом режиме каждый фрагмент обычно соответствует одному токену
+                    TOKENS_OUT.inc()
+                    yield content
+    except Exception:
+        INFERENCE_ERRORS.inc()
+        raise
+    finally:
+        INFERENCE_SECONDS.observe(time.perf_counter() - started)
+
+# Сколько секунд Telegram просит подождать (retry_after бывает числом или timedelta)
+def _retry_after_seconds(exc) -> float:
+    retry_after = exc.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+# Стриминговый ответ: первое сообщение отправляем сразу, дальше редактируем его не чаще stream_edit_interval
+async def reply_streaming(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, user_message: str) -> None:
+    conversation_manager.add_user_message(user_id, user_message)
+    messages = to_api_messages(conversation_manager.get_history(user_id))
+
+    cache_key = _response_cache_key(messages)
+    cached = RESPONSE_CACHE.get(cache_key) if cache_key else None
+    if cached:
+        with TELEGRAM_SEND_SECONDS.time():
+            await update.message.reply_text(_finalize_response(user_id, cached))
+        return
+
+    from telegram.error import RetryAfter, TelegramError
+
+    loop = asyncio.get_running_loop()
+    chat_id = update.effective_chat.id
+    sent = None
+    shown = ""
+    last_edit = 0.0
+    paused_until = 0.0
+    think = ThinkFilter(max_visible=TELEGRAM_MESSAGE_LIMIT)
+
+    async def show(text: str) -> None:
+        nonlocal sent, shown, last_edit
+        with TELEGRAM_SEND_SECONDS.time():
+            if sent is None:
+                sent = await update.message.reply_text(text)
+            elif text != shown:
+                await context.bot.edit_message_text(text, chat_id=chat_id, message_id=sent.message_id)
+        shown = text
+        last_edit = loop.time()
+
+    # Промежуточные правки необязательны: ошибка Telegram не прерывает генерацию, а RetryAfter откладывает следующие правки
+    async def show_progress(text: str) -> None:
+        nonlocal paused_until
+        try:
+            await show(text)
+        except RetryAfter as exc:
+            paused_until = loop.time() + _retry_after_seconds(exc)
+        except TelegramError as exc:
+            logger.warning("Не удалось обновить потоковый ответ пользователю %s: %s", user_id, exc)
+
+    try:
+        async with aclosing(_stream_completion(messages)) as chunks:
+            async for chunk in chunks:
+                think.feed(chunk)
+                if think.answer_complete:
+                    # Ответ закончен (модель снова рассуждает или сообщение заполнено): остальное не ждём
+                    STREAM_EARLY_STOPS.inc()
+                    break
+                if loop.time() < paused_until:
+                    continue
+                if sent is not None and loop.time() - last_edit < CONFIG.stream_edit_interval:
+                    continue
+                visible = think.text.strip()
+                if visible:
+                    await show_progress(visible)
+        think.finish()
+        response = think.text.strip()[:TELEGRAM_MESSAGE_LIMIT]
+        _store_cached_response(cache_key, response)
+        response = _finalize_response(user_id, response)
+    except Exception as exc:
+        logger.exception("Ошибка при потоковом запросе к Hugging Face Inference API: %s", exc)
+        response = "Извините, не удалось обработать запрос."
+
+    # Финальная правка гарантирует, что пользователь увидит ответ целиком; сам ответ уже сохранён в истории
+    try:
+        await show(response)
+    except RetryAfter as exc:
+        await asyncio.sleep(max(_retry_after_seconds(exc), paused_until - loop.time()))
+        await show(response)
     
 # Обрабатываем команду /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -152,11 +575,92 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     conversation_manager.clear_history(user_id)
+    if LOCAL_GENERATOR is not None and LOCAL_GENERATOR.prefix_cache is not None:
+        LOCAL_GENERATOR.prefix_cache.discard(user_id)
     if update.message is None:
         return
     logger.info("История пользователя %s очищена по команде.", user_id)
     await update.message.reply_text("История диалога очищена!")
 
+# Сообщения, пришедшие во время генерации ответа пользователю; наличие ключа означает, что генерация идёт
+_pending_messages: Dict[int, List[Tuple[Update, str]]] = {}
+
+# Генерируем ответ на одну реплику пользователя и отправляем его
+async def _answer(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, text: str) -> bool:
+    from telegram.error import TelegramError
+
+    try:
+        # Показываем индикатор набора, чтобы пользователь видел, что бот обрабатывает запрос.
+        # Индикатор необязателен: сетевая ошибка или RetryAfter не должны оставить реплику без ответа
+        try:
+            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+        except TelegramError as exc:
+            logger.warning("Не удалось показать индикатор набора пользователю %s: %s", user_id, exc)
+
+        # Локальная модель считает в пуле потоков (напрямую или пакетами); стриминг и асинхронный клиент работают только с API
+        remote = LOCAL_GENERATOR is None
+        async with ADMISSION.slot(user_id):
+            if CONFIG.stream_replies and remote:
+                await reply_streaming(update, context, user_id, text)
+                logger.info("Ответ пользователю %s отправлен успешно.", user_id)
+                return True
+            if (CONFIG.use_async_client and remote) or BATCH_SCHEDULER is not None:
+                response = await generate_response_async(user_id, text)
+            else:
+                # Запасной путь: синхронная генерация в отдельном пуле потоков
+                response = await run_generate_response_in_executor(user_id, text)
+        with TELEGRAM_SEND_SECONDS.time():
+            await update.message.reply_text(response)
+        logger.info("Ответ пользователю %s отправлен успешно.", user_id)
+        return True
+    except Overloaded as exc:
+        logger.warning("Запрос пользователя %s отклонён (%s), статистика: %s", user_id, exc.reason, ADMISSION.stats())
+        await update.message.reply_text("Сейчас бот перегружен. Попробуйте чуть позже.")
+    except Exception as exc:
+        logger.exception("Ошибка при обработке сообщения от %s: %s", user_id, exc)
+        await update.message.reply_text("Произошла ошибка при обработке запроса. Попробуйте позже.")
+    return False
+
+# Сворачивает вытесненные из истории реплики в краткое содержание (HISTORY_SUMMARIZE=1)
+async def _summarize_history(user_id: int) -> None:
+    request = conversation_manager.build_summary_request(user_id)
+    if request is None:
+        return
+
+    messages, turns = request
+    try:
+        # Сжатие - такой же запрос к модели, как ответ, поэтому занимает общий слот. Лимит пользователя
+        # не расходуется: иначе фоновая работа бота отнимала бы у него право на следующее сообщение
+        async with ADMISSION.slot(user_id, rate_limited=False):
+            with HISTORY_SUMMARY_SECONDS.time():
+                if LOCAL_GENERATOR is not None:
+                    prompt = conversation_manager.build_prompt_from_history(messages)
+                    loop = asyncio.get_running_loop()
+                    content = await loop.run_in_executor(INFERENCE_EXECUTOR, LOCAL_GENERATOR.generate, prompt)
+                    summary = _clean_model_output(content.strip())
+                else:
+                    completion = await RETRY_POLICY.call(
+                        lambda: _create_completion_async(messages, CONFIG.history_summary_max_tokens),
+                        hedge=False,
+                    )
+                    _record_usage(completion)
+                    summary = _extract_content(completion)
+    except Overloaded as exc:
+        # Бот перегружен: вытесненные реплики подождут следующего ответа пользователю
+        logger.info("Сжатие истории пользователя %s отложено (%s).", user_id, exc.reason)
+        return
+    except Exception as exc:
+        HISTORY_SUMMARY_ERRORS.inc()
+        logger.warning("Не удалось сжать историю пользователя %s: %s", user_id, exc)
+        return
+
+    # Пустой ответ не затирает прежнее краткое содержание, реплики попробуем сжать в следующий раз
+    if not summary:
+        HISTORY_SUMMARY_ERRORS.inc()
+        return
+    if conversation_manager.apply_summary(user_id, summary, turns):
+        logger.info("История пользователя %s сжата: %s реплик.", user_id, len(turns))
+
 # Обрабатываем текстовое сообщение
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message is None:
@@ -169,19 +673,42 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("Пожалуйста, отправьте текстовое сообщение.")
         return
 
-    # Показываем индикатор набора, чтобы пользователь видел, что бот обрабатывает запрос
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+    logger.info("Получено сообщение от %s: %s", user_id, text[:60])
 
-    # Запускаем генерацию ответа в отдельном потоке
-    loop = asyncio.get_running_loop()
+    # Пока для пользователя идёт генерация, новые сообщения только копятся, чтобы не портить общую историю
+    pending = _pending_messages.get(user_id)
+    if pending is not None:
+        pending.append((update, text))
+        return
+
+    _pending_messages[user_id] = []
     try:
-        logger.info("Получено сообщение от %s: %s", user_id, text[:60])
-        response = await loop.run_in_executor(None, generate_response, user_id, text)
-        await update.message.reply_text(response)
-        logger.info("Ответ пользователю %s отправлен успешно.", user_id)
-    except Exception as exc:
-        logger.exception("Ошибка при обработке сообщения от %s: %s", user_id, exc)
-        await update.message.reply_text("Произошла ошибка при обработке запроса. Попробуйте позже.")
+        while True:
+            try:
+                answered = await _answer(update, context, user_id, text)
+            except Exception as exc:
+                # Не удалось даже сообщить об ошибке (например, Telegram недоступен). Накопленные реплики
+                # всё равно обрабатываем: иначе они пропали бы без ответа и без записи в историю
+                logger.exception("Не удалось ответить пользователю %s: %s", user_id, exc)
+                answered = False
+            # Сжатие идёт уже после отправки ответа, но до следующей реплики пользователя,
+            # чтобы история не менялась одновременно из двух мест. Если ответа не было (перегрузка
+            # или ошибка), лишний запрос к модели не отправляем
+            if answered and CONFIG.history_summarize:
+                await _summarize_history(user_id)
+            queued = _pending_messages[user_id]
+            if not queued:
+                break
+            # Всё, что пришло за время генерации, объединяем в одну реплику и отвечаем одним вызовом модели
+            _pending_messages[user_id] = []
+            update = queued[-1][0]
+            text = "\n".join(queued_text for _, queued_text in queued)
+            logger.info("Объединено %s сообщений пользователя %s в одну реплику.", len(queued), user_id)
+    finally:
+        # Остаток возможен, только если обработку прервали (остановка бота)
+        queued = _pending_messages.pop(user_id)
+        if queued:
+            logger.warning("Не обработано сообщений пользователя %s: %s.", user_id, len(queued))
 
 # Обрабатываем нетекстовое сообщение
 async def handle_non_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -189,21 +716,99 @@ async def handle_non_text(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     await update.message.reply_text("Пожалуйста, отправьте текстовое сообщение.")
 
-
-def main() -> None:
-    if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
-        raise RuntimeError("TELEGRAM_TOKEN не задан. Установите переменную окружения TELEGRAM_TOKEN.")
-
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+# Периодически удаляем неактивные диалоги вне пути обработки сообщений
+async def _purge_loop(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        conversation_manager.purge_inactive()
+        conversation_manager.flush()
+        if LOCAL_GENERATOR is not None and LOCAL_GENERATOR.prefix_cache is not None:
+            LOCAL_GENERATOR.prefix_cache.purge()
+
+# Периодически записываем отложенные изменения истории, чтобы неполная пачка не ждала следующих сообщений
+async def _flush_loop(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        conversation_manager.flush()
+
+# Фоновые задачи бота; Application.stop() ждёт завершения своих задач, поэтому бесконечные циклы храним отдельно
+_background_tasks: List[asyncio.Task] = []
+
+# Запускаем фоновые задачи после инициализации приложения
+async def _post_init(application: Application) -> None:
+    if CONFIG.metrics_port > 0:
+        start_metrics_server(CONFIG.metrics_port, CONFIG.metrics_listen)
+        logger.info("Метрики доступны на http://%s:%s/metrics", CONFIG.metrics_listen, CONFIG.metrics_port)
+    if CONFIG.history_purge_interval > 0:
+        _background_tasks.append(asyncio.create_task(_purge_loop(CONFIG.history_purge_interval)))
+    if CONFIG.history_backend == "sqlite" and CONFIG.history_flush_interval > 0:
+        _background_tasks.append(asyncio.create_task(_flush_loop(CONFIG.history_flush_interval)))
+
+# Перед остановкой гасим фоновые задачи и записываем накопленные изменения истории в хранилище
+async def _post_shutdown(application: Application) -> None:
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    if BATCH_SCHEDULER is not None:
+        await BATCH_SCHEDULER.close()
+    conversation_manager.close()
+    if CONFIG.response_cache_size > 0:
+        logger.info("Статистика кэша ответов: %s", RESPONSE_CACHE.stats())
+    if len(BACKENDS.backends) > 1:
+        logger.info("Состояние бэкендов модели: %s", BACKENDS.stats())
+    if CONFIG.inference_backend != "local":
+        logger.info("Соединения с API модели: %s", connection_stats())
+
+
+# Фабрика приложения: создаёт сервисы бота и Application с обработчиками
+def create_application(config: Optional[BotConfig] = None) -> Application:
+    from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters
+
+    config = init_services(config)
+    builder = (
+        ApplicationBuilder()
+        .token(config.telegram_token)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        # Пользователи обслуживаются параллельно, сообщения одного пользователя сериализует handle_message
+        .concurrent_updates(config.concurrent_updates)
+    )
+    if config.telegram_api_url:
+        builder = builder.base_url(config.telegram_api_url)
+    if config.update_mode == "webhook" or config.workers > 1:
+        # Обновления приходят в наш webhook-сервер или от супервизора, встроенный Updater не нужен
+        builder = builder.updater(None)
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("clear", clear_command))
     application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message))
     application.add_handler(MessageHandler(~filters.TEXT & (~filters.COMMAND), handle_non_text))
+    return application
+
+
+def main() -> None:
+    config = load_config()
+    if config.workers > 1:
+        from supervisor import run_supervisor
+
+        run_supervisor(config)
+        return
+
+    application = create_application(config)
 
     logger.info("Бот запущен и готов принимать сообщения.")
-    application.run_polling()
+    if CONFIG.update_mode == "webhook":
+        from webhook_server import serve_webhook
+
+        asyncio.run(serve_webhook(application, CONFIG))
+    else:
+        application.run_polling()
+
+    # Дожидаемся завершения начатых генераций и освобождаем потоки
+    INFERENCE_EXECUTOR.shutdown(wait=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,362 @@
+from __future__ import annotations
+
+import asyncio
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import Any, Hashable, List, Optional, Tuple
+
+from conversation_utils import BotConfig, ConversationManager
+from metrics import (
+    LOCAL_BATCH_SIZE,
+    PREFIX_CACHE_BYTES,
+    PREFIX_CACHE_HITS,
+    PREFIX_CACHE_MISSES,
+    PREFIX_CACHE_REUSED_TOKENS,
+    SYSTEM_PREFIX_HITS,
+    TOKENS_IN,
+    TOKENS_OUT,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Выбираем устройство для модели: auto - видеокарта, если она есть, иначе CPU
+def _resolve_device(torch: Any, model_device: str) -> str:
+    if model_device and model_device != "auto":
+        return model_device
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+# Размер KV-кэша в байтах; поддерживаем и старый (key_cache/value_cache), и новый (layers) формат DynamicCache
+def _cache_nbytes(cache: Any) -> int:
+    layers = getattr(cache, "layers", None)
+    if layers is not None:
+        tensors = [
+            tensor
+            for layer in layers
+            for tensor in (getattr(layer, "keys", None), getattr(layer, "values", None))
+            if tensor is not None
+        ]
+    else:
+        tensors = list(getattr(cache, "key_cache", [])) + list(getattr(cache, "value_cache", []))
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+# Длина общего начала двух последовательностей токенов
+def _common_prefix_length(left: List[int], right: List[int]) -> int:
+    length = 0
+    for a, b in zip(left, right):
+        if a != b:
+            break
+        length += 1
+    return length
+
+
+@dataclass
+class PrefixEntry:
+    token_ids: List[int]  # токены, для которых посчитан KV-кэш
+    cache: Any  # DynamicCache из transformers
+    nbytes: int
+    updated_at: float
+
+
+class PrefixCache:
+    # KV-кэш префикса диалога для каждого пользователя. Следующий промпт пользователя начинается с уже посчитанных
+    # токенов (системный промпт, прошлые реплики), поэтому модели остаётся посчитать только новую реплику.
+    # Префикс проверяется сравнением токенов; записи вытесняются по бюджету памяти (LRU) и по TTL истории.
+    def __init__(self, budget_bytes: int, ttl_seconds: float):
+        self._budget = budget_bytes
+        self._ttl = ttl_seconds
+        self._entries: OrderedDict[Hashable, PrefixEntry] = OrderedDict()
+        self._nbytes = 0
+        # Генерация идёт в нескольких потоках пула
+        self._lock = threading.Lock()
+
+    def _now(self) -> float:
+        return time.time()
+
+    # Забирает кэш пользователя, обрезанный до общего с новым промптом начала; запись на время генерации удаляется
+    def take(self, key: Hashable, token_ids: List[int]) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._nbytes -= entry.nbytes
+                PREFIX_CACHE_BYTES.set(self._nbytes)
+        if entry is None:
+            PREFIX_CACHE_MISSES.inc()
+            return None
+
+        # Хотя бы один токен промпта модель должна посчитать сама, чтобы получить логиты для генерации
+        usable = min(_common_prefix_length(entry.token_ids, token_ids), len(token_ids) - 1)
+        if usable <= 0:
+            PREFIX_CACHE_MISSES.inc()
+            return None
+
+        entry.cache.crop(usable)
+        PREFIX_CACHE_HITS.inc()
+        PREFIX_CACHE_REUSED_TOKENS.inc(usable)
+        return entry.cache
+
+    def put(self, key: Hashable, token_ids: List[int], cache: Any) -> None:
+        nbytes = _cache_nbytes(cache)
+        if nbytes > self._budget:
+            return
+
+        entry = PrefixEntry(token_ids=token_ids, cache=cache, nbytes=nbytes, updated_at=self._now())
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._nbytes -= previous.nbytes
+            self._entries[key] = entry
+            self._nbytes += nbytes
+            self._purge_locked()
+            while self._nbytes > self._budget and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+            PREFIX_CACHE_BYTES.set(self._nbytes)
+
+    # Удаляет записи старше TTL истории, как ConversationManager.purge_inactive удаляет сами диалоги
+    def purge(self) -> None:
+        with self._lock:
+            self._purge_locked()
+            PREFIX_CACHE_BYTES.set(self._nbytes)
+
+    def _purge_locked(self) -> None:
+        if self._ttl <= 0:
+            return
+        deadline = self._now() - self._ttl
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.updated_at >= deadline:
+                break
+            del self._entries[key]
+            self._nbytes -= entry.nbytes
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._nbytes -= entry.nbytes
+                PREFIX_CACHE_BYTES.set(self._nbytes)
+
+
+class LocalGenerator:
+    # Генерация ответов моделью model_name прямо в процессе бота через transformers, без сетевых запросов
+    def __init__(self, config: BotConfig):
+        try:
+            import torch
+            from transformers import AutoModelForCausalLM, AutoTokenizer
+        except ImportError as exc:
+            raise RuntimeError(
+                "Для локального запуска модели нужны пакеты transformers и torch."
+            ) from exc
+
+        self._torch = torch
+        self._config = config
+        if config.local_threads > 0:
+            torch.set_num_threads(config.local_threads)
+
+        self.device = _resolve_device(torch, config.model_device)
+        token = config.hf_token if config.hf_token and config.hf_token != "YOUR_HF_TOKEN" else None
+        logger.info("Загружаю модель %s на устройство %s.", config.model_name, self.device)
+        self.tokenizer = AutoTokenizer.from_pretrained(config.model_name, token=token)
+        # Для пакетной генерации промпты выравниваются паддингом слева, чтобы продолжение шло сразу за текстом
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        model = AutoModelForCausalLM.from_pretrained(config.model_name, token=token)
+        model.to(self.device)
+        model.eval()
+
+        # Динамическое int8-квантование линейных слоёв ускоряет генерацию на CPU ценой небольшой потери качества
+        if config.local_quantize_int8:
+            if self.device == "cpu":
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                logger.info("Модель квантована в int8.")
+            else:
+                logger.warning("int8-квантование поддерживается только на CPU, пропускаю.")
+        self.model = model
+
+        self.prefix_cache: Optional[PrefixCache] = None
+        if config.local_prefix_cache_mb > 0:
+            self.prefix_cache = PrefixCache(config.local_prefix_cache_mb * 1024 * 1024, config.history_ttl_seconds)
+
+        # KV-состояние системного промпта одинаково для всех пользователей: считаем его один раз на процесс
+        self._share_system_cache = config.local_system_prompt_cache
+        self._system_prefix: Optional[Tuple[List[int], Any]] = None
+        self._system_prefix_lock = threading.Lock()
+
+    # Параметры генерации из BotConfig; при temperature = 0 используется жадный поиск
+    def _generation_kwargs(self) -> dict:
+        config = self._config
+        kwargs = {
+            "max_new_tokens": config.max_new_tokens,
+            "repetition_penalty": config.repetition_penalty,
+            "pad_token_id": self.tokenizer.pad_token_id or self.tokenizer.eos_token_id,
+        }
+        if config.temperature > 0:
+            kwargs.update(do_sample=True, temperature=config.temperature, top_p=config.top_p)
+        else:
+            kwargs["do_sample"] = False
+        return kwargs
+
+    # Генерирует продолжение для готового промпта (см. ConversationManager.build_prompt).
+    # С cache_key (обычно user_id) переиспользует KV-кэш прошлого хода этого диалога.
+    def generate(self, prompt: str, cache_key: Optional[Hashable] = None) -> str:
+        use_prefix_cache = cache_key is not None and self.prefix_cache is not None
+        if not use_prefix_cache and not self._share_system_cache:
+            return self.generate_batch([prompt])[0]
+
+        input_ids = self.tokenizer(prompt, return_tensors="pt", add_special_tokens=False)["input_ids"].to(self.device)
+        token_ids = input_ids[0].tolist()
+        past_key_values = self.prefix_cache.take(cache_key, token_ids) if use_prefix_cache else None
+        if past_key_values is None and self._share_system_cache:
+            past_key_values = self._system_prefix_cache(token_ids)
+        with self._torch.inference_mode():
+            output = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=self._torch.ones_like(input_ids),
+                past_key_values=past_key_values,
+                return_dict_in_generate=True,
+                **self._generation_kwargs(),
+            )
+
+        sequence = output.sequences[0]
+        new_tokens = sequence[len(token_ids):]
+        TOKENS_IN.inc(len(token_ids))
+        TOKENS_OUT.inc(len(new_tokens))
+
+        # Кэш покрывает промпт и ответ (кроме последнего токена): следующий ход пользователя начнётся с них же
+        cache = output.past_key_values
+        if use_prefix_cache and cache is not None:
+            self.prefix_cache.put(cache_key, sequence[: cache.get_seq_length()].tolist(), cache)
+        return self.tokenizer.decode(new_tokens, skip_special_tokens=True)
+
+    # Считает KV-кэш системного промпта при первом обращении; дальше он только читается
+    def _get_system_prefix(self) -> Tuple[List[int], Any]:
+        with self._system_prefix_lock:
+            if self._system_prefix is None:
+                system = {"role": "system", "content": self._config.system_prompt}
+                if hasattr(self.tokenizer, "apply_chat_template"):
+                    text = self.tokenizer.apply_chat_template([system], tokenize=False, add_generation_prompt=False)
+                else:
+                    text = ConversationManager._render_message(system)
+                input_ids = self.tokenizer(text, return_tensors="pt", add_special_tokens=False)["input_ids"].to(self.device)
+                with self._torch.inference_mode():
+                    output = self.model(input_ids=input_ids, use_cache=True)
+                self._system_prefix = (input_ids[0].tolist(), output.past_key_values)
+            return self._system_prefix
+
+    # Копия общего кэша системного промпта для нового диалога; generate дописывает в кэш, поэтому оригинал не отдаём
+    def _system_prefix_cache(self, token_ids: List[int]) -> Optional[Any]:
+        system_ids, system_cache = self._get_system_prefix()
+        usable = min(_common_prefix_length(system_ids, token_ids), len(token_ids) - 1)
+        if usable <= 0:
+            return None
+
+        cache = copy.deepcopy(system_cache)
+        if usable < len(system_ids):
+            cache.crop(usable)
+        SYSTEM_PREFIX_HITS.inc()
+        PREFIX_CACHE_REUSED_TOKENS.inc(usable)
+        return cache
+
+    # Генерирует продолжения для нескольких промптов одним вызовом model.generate
+    def generate_batch(self, prompts: List[str]) -> List[str]:
+        inputs = self.tokenizer(
+            prompts,
+            return_tensors="pt",
+            padding=True,
+            add_special_tokens=False,
+        ).to(self.device)
+        prompt_length = inputs["input_ids"].shape[1]
+        with self._torch.inference_mode():
+            output = self.model.generate(**inputs, **self._generation_kwargs())
+
+        results: List[str] = []
+        pad_id = self.tokenizer.pad_token_id
+        TOKENS_IN.inc(int(inputs["attention_mask"].sum()))
+        for row in output:
+            new_tokens = row[prompt_length:]
+            TOKENS_OUT.inc(int((new_tokens != pad_id).sum()))
+            results.append(self.tokenizer.decode(new_tokens, skip_special_tokens=True))
+        return results
+
+
+class BatchScheduler:
+    # Собирает запросы от параллельных handle_message в пакеты: ждёт не дольше max_wait или до max_batch_size
+    # промптов и отдаёт пакет в один model.generate. Пока пакет считается, новые запросы копят следующий пакет.
+    def __init__(self, generator: LocalGenerator, executor: Executor, max_batch_size: int, max_wait: float):
+        self._generator = generator
+        self._executor = executor
+        self._max_batch_size = max(max_batch_size, 1)
+        self._max_wait = max(max_wait, 0.0)
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def generate(self, prompt: str, cache_key: Optional[Hashable] = None) -> str:
+        # Очередь и обработчик создаются в работающем event loop при первом запросе
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, cache_key, future))
+        return await future
+
+    async def _collect_batch(self) -> List[Tuple[str, Optional[Hashable], asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self._max_wait
+        while len(batch) < self._max_batch_size:
+            # Всё, что уже лежит в очереди, забираем без ожидания
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Запросы, которые перестали ждать ответа, не считаем
+        return [item for item in batch if not item[2].done()]
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            if not batch:
+                continue
+
+            LOCAL_BATCH_SIZE.observe(len(batch))
+            try:
+                if len(batch) == 1:
+                    # Одиночный запрос может переиспользовать KV-кэш префикса своего диалога
+                    prompt, cache_key, _ = batch[0]
+                    outputs = [await loop.run_in_executor(self._executor, self._generator.generate, prompt, cache_key)]
+                else:
+                    prompts = [prompt for prompt, _, _ in batch]
+                    outputs = await loop.run_in_executor(self._executor, self._generator.generate_batch, prompts)
+            except Exception as exc:
+                logger.exception("Ошибка пакетной генерации: %s", exc)
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+
+            for (_, _, future), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result(output)
+
+    async def close(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+# Простые метрики в формате Prometheus без внешних зависимостей.
+# Значения обновляются и из event loop, и из пула потоков, поэтому каждая метрика защищена блокировкой.
+
+Sample = Tuple[str, float]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self) -> List[Sample]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def samples(self) -> List[Sample]:
+        return [(self.name, self._value)]
+
+
+class Gauge(Metric):
+    # Значение задаётся явно или читается функцией в момент выдачи метрик
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation)
+        self._value = 0.0
+        self._function = function
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def samples(self) -> List[Sample]:
+        value = self._function() if self._function is not None else self._value
+        return [(self.name, float(value))]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self._bounds = list(buckets)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    # Замеряет длительность блока кода в секундах
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+        result: List[Sample] = []
+        cumulative = 0
+        for bound, bucket_count in zip(self._bounds, counts):
+            cumulative += bucket_count
+            result.append((f'{self.name}_bucket{{le="{bound}"}}', cumulative))
+        result.append((f'{self.name}_bucket{{le="+Inf"}}', count))
+        result.append((f"{self.name}_sum", total))
+        result.append((f"{self.name}_count", count))
+        return result
+
+
+REGISTRY: List[Metric] = []
+
+
+# Текстовый формат выдачи Prometheus
+def render() -> str:
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, value in metric.samples():
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+# Поднимает /metrics в фоновом потоке, чтобы сбор метрик не зависел от загрузки event loop
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+# Метрики бота
+EXECUTOR_QUEUE_SECONDS = Histogram(
+    "bot_executor_queue_seconds", "Время ожидания свободного потока для синхронной генерации"
+)
+EXECUTOR_QUEUE_LENGTH = Gauge("bot_executor_queue_length", "Задачи генерации, ожидающие свободного потока")
+EXECUTOR_BUSY_THREADS = Gauge("bot_executor_busy_threads", "Потоки пула генерации, занятые запросами")
+EXECUTOR_THREADS = Gauge("bot_executor_threads", "Размер пула потоков генерации")
+INFERENCE_SECONDS = Histogram("bot_inference_seconds", "Длительность запроса к модели")
+INFERENCE_ERRORS = Counter("bot_inference_errors_total", "Ошибки запросов к модели")
+TOKENS_IN = Counter("bot_tokens_in_total", "Токены промпта, отправленные модели")
+TOKENS_OUT = Counter("bot_tokens_out_total", "Токены, сгенерированные моделью")
+HISTORY_TRUNCATE_SECONDS = Histogram(
+    "bot_history_truncate_seconds",
+    "Длительность сокращения истории",
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1),
+)
+HISTORY_PURGE_SECONDS = Histogram(
+    "bot_history_purge_seconds",
+    "Длительность очистки неактивных диалогов",
+    buckets=(0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0),
+)
+STORE_SIZE = Gauge("bot_conversation_store_size", "Число диалогов в памяти")
+TELEGRAM_SEND_SECONDS = Histogram("bot_telegram_send_seconds", "Длительность отправки сообщения в Telegram")
+RESPONSE_CACHE_HITS = Counter("bot_response_cache_hits_total", "Ответы, взятые из кэша")
+RESPONSE_CACHE_MISSES = Counter("bot_response_cache_misses_total", "Промахи кэша ответов")
+ADMISSION_WAIT_SECONDS = Histogram("bot_admission_wait_seconds", "Ожидание свободного слота для запроса к модели")
+ADMISSION_IN_FLIGHT = Gauge("bot_admission_in_flight", "Запросы к модели, выполняющиеся сейчас")
+ADMISSION_QUEUE_DEPTH = Gauge("bot_admission_queue_depth", "Запросы, ожидающие свободного слота")
+ADMISSION_SHED = Counter("bot_admission_shed_total", "Запросы, отклонённые из-за перегрузки")
+LOCAL_BATCH_SIZE = Histogram(
+    "bot_local_batch_size",
+    "Число промптов в одном пакете локальной генерации",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+PREFIX_CACHE_HITS = Counter("bot_prefix_cache_hits_total", "Генерации, начатые с KV-кэша префикса диалога")
+PREFIX_CACHE_MISSES = Counter("bot_prefix_cache_misses_total", "Генерации без подходящего KV-кэша префикса")
+PREFIX_CACHE_REUSED_TOKENS = Counter(
+    "bot_prefix_cache_reused_tokens_total", "Токены промпта, которые не пришлось считать заново"
+)
+PREFIX_CACHE_BYTES = Gauge("bot_prefix_cache_bytes", "Память, занятая KV-кэшами префиксов")
+SYSTEM_PREFIX_HITS = Counter(
+    "bot_system_prefix_hits_total", "Генерации, начатые с общего KV-кэша системного промпта"
+)
+HISTORY_SUMMARY_SECONDS = Histogram("bot_history_summary_seconds", "Длительность сжатия вытесненных реплик")
+HISTORY_SUMMARY_ERRORS = Counter("bot_history_summary_errors_total", "Неудачные попытки сжатия истории")
+INFERENCE_ATTEMPT_SECONDS = Histogram("bot_inference_attempt_seconds", "Длительность одной попытки запроса к модели")
+INFERENCE_CALL_ATTEMPTS = Histogram(
+    "bot_inference_call_attempts",
+    "Число попыток (включая повторы) на один запрос к модели",
+    buckets=(1, 2, 3, 4, 6, 10),
+)
+INFERENCE_RETRIES = Counter("bot_inference_retries_total", "Повторные попытки запроса к модели")
+INFERENCE_TIMEOUTS = Counter("bot_inference_timeouts_total", "Попытки, прерванные по таймауту")
+INFERENCE_HEDGES = Counter("bot_inference_hedges_total", "Дублирующие (hedged) запросы к модели")
+INFERENCE_HEDGE_WINS = Counter("bot_inference_hedge_wins_total", "Дублирующие запросы, ответившие первыми")
+BACKENDS_HEALTHY = Gauge("bot_inference_backends_healthy", "Бэкенды модели в ротации")
+BACKEND_EJECTIONS = Counter("bot_inference_backend_ejections_total", "Выводы бэкендов из ротации circuit breaker'ом")
+HTTP_POOL_SIZE = Gauge("bot_http_pool_size", "Максимум соединений в HTTP-пуле клиента модели")
+HTTP_REQUESTS = Counter("bot_http_requests_total", "HTTP-запросы клиента модели")
+HTTP_CONNECTIONS = Counter("bot_http_connections_total", "Новые TCP-соединения клиента модели")
+HTTP_TLS_HANDSHAKES = Counter("bot_http_tls_handshakes_total", "TLS-рукопожатия клиента модели")
+STREAM_EARLY_STOPS = Counter(
+    "bot_stream_early_stops_total", "Потоковые ответы, оборванные после конца видимого ответа"
+)
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Deque, Optional, TypeVar
+
+from conversation_utils import BotConfig
+from metrics import (
+    INFERENCE_ATTEMPT_SECONDS,
+    INFERENCE_CALL_ATTEMPTS,
+    INFERENCE_HEDGE_WINS,
+    INFERENCE_HEDGES,
+    INFERENCE_RETRIES,
+    INFERENCE_TIMEOUTS,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Ответы, после которых запрос имеет смысл повторить
+RETRYABLE_STATUS = frozenset((408, 425, 429, 500, 502, 503, 504))
+# По скольким последним попыткам считается задержка дублирующего запроса и сколько их нужно для начала
+LATENCY_WINDOW = 256
+HEDGE_MIN_SAMPLES = 20
+HEDGE_RECOMPUTE_EVERY = 16
+
+
+# Код HTTP-ответа из исключения huggingface_hub (requests или httpx) либо None
+def _status_code(exc: BaseException) -> Optional[int]:
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+# Retry-After в секундах: число секунд или HTTP-дата
+def retry_after(exc: BaseException) -> Optional[float]:
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    value = headers.get("Retry-After") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(exc: BaseException) -> bool:
+    # Ошибки HTTP huggingface_hub наследуют OSError, поэтому сначала смотрим на код ответа
+    status = _status_code(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError, OSError)):
+        return True
+    # Сетевые ошибки httpx не наследуют OSError
+    return any(cls.__name__ == "TransportError" for cls in type(exc).__mro__)
+
+
+class RetryPolicy:
+    # Таймаут каждой попытки, повторы с экспоненциальной задержкой и джиттером (с учётом Retry-After)
+    # и необязательный дублирующий запрос, если первый не ответил за p95 недавних попыток
+    def __init__(self, config: BotConfig):
+        self._timeout = config.inference_timeout
+        self._retries = max(config.inference_retries, 0)
+        self._backoff = config.retry_backoff
+        self._backoff_max = config.retry_backoff_max
+        self._hedge = config.inference_hedge
+        self._hedge_percentile = config.inference_hedge_percentile
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._hedge_delay: Optional[float] = None
+        self._since_recompute = 0
+        # Синхронный путь работает из пула потоков
+        self._lock = threading.Lock()
+
+    def _record_latency(self, seconds: float) -> None:
+        INFERENCE_ATTEMPT_SECONDS.observe(seconds)
+        with self._lock:
+            self._latencies.append(seconds)
+            self._since_recompute += 1
+            # Перцентиль пересчитываем не на каждую попытку, сортировка окна стоит дороже самой записи
+            if len(self._latencies) >= HEDGE_MIN_SAMPLES and self._since_recompute >= HEDGE_RECOMPUTE_EVERY:
+                ordered = sorted(self._latencies)
+                index = min(int(len(ordered) * self._hedge_percentile / 100), len(ordered) - 1)
+                self._hedge_delay = ordered[index]
+                self._since_recompute = 0
+
+    # Через сколько секунд отправлять дублирующий запрос; None - пока рано или дублирование выключено
+    def hedge_delay(self) -> Optional[float]:
+        return self._hedge_delay if self._hedge else None
+
+    # Пауза перед следующей попыткой или None, если повторять не нужно
+    def _next_delay(self, attempt: int, exc: BaseException) -> Optional[float]:
+        if attempt >= self._retries or not is_retryable(exc):
+            return None
+        # "Full jitter": равномерно от нуля до экспоненциальной границы, чтобы повторы разных запросов не совпадали
+        delay = random.uniform(0, min(self._backoff_max, self._backoff * 2 ** attempt))
+        wait = retry_after(exc)
+        if wait is not None:
+            # Раньше, чем просит сервер, не повторяем; если ждать дольше предела, отвечаем ошибкой сразу
+            if wait > self._backoff_max:
+                return None
+            delay = max(delay, wait)
+        return delay
+
+    # Таймаут одной попытки. Его применяет сама попытка, чтобы ошибку увидел и пул бэкендов
+    async def with_timeout(self, awaitable: Awaitable[T]) -> T:
+        if self._timeout <= 0:
+            return await awaitable
+        try:
+            return await asyncio.wait_for(awaitable, self._timeout)
+        except asyncio.TimeoutError:
+            INFERENCE_TIMEOUTS.inc()
+            raise
+
+    async def _request(self, factory: Callable[[], Awaitable[T]]) -> T:
+        started = time.perf_counter()
+        result = await factory()
+        self._record_latency(time.perf_counter() - started)
+        return result
+
+    # Первый успешный из основного и дублирующего запросов; оставшийся отменяется
+    async def _hedged(self, factory: Callable[[], Awaitable[T]], delay: float) -> T:
+        primary = asyncio.ensure_future(self._request(factory))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+
+        INFERENCE_HEDGES.inc()
+        backup = asyncio.ensure_future(self._request(factory))
+        pending = {primary, backup}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            INFERENCE_HEDGE_WINS.inc()
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    # Асинхронный вызов модели; hedge=False для потоковых запросов, которые нельзя дублировать
+    async def call(self, factory: Callable[[], Awaitable[T]], hedge: bool = True) -> T:
+        attempt = 0
+        try:
+            while True:
+                try:
+                    delay = self.hedge_delay() if hedge else None
+                    if delay is None:
+                        return await self._request(factory)
+                    return await self._hedged(factory, delay)
+                except Exception as exc:
+                    pause = self._next_delay(attempt, exc)
+                    if pause is None:
+                        raise
+                    INFERENCE_RETRIES.inc()
+                    logger.warning("Повтор запроса к модели через %.2f с (попытка %s): %r", pause, attempt + 2, exc)
+                    await asyncio.sleep(pause)
+                    attempt += 1
+        finally:
+            INFERENCE_CALL_ATTEMPTS.observe(attempt + 1)
+
+    # Синхронный вызов из пула потоков: таймаут попытки задаёт сам клиент (параметр timeout), дублирования нет
+    def call_sync(self, function: Callable[[], Any]) -> Any:
+        attempt = 0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    result = function()
+                except Exception as exc:
+                    if isinstance(exc, TimeoutError):
+                        INFERENCE_TIMEOUTS.inc()
+                    pause = self._next_delay(attempt, exc)
+                    if pause is None:
+                        raise
+                    INFERENCE_RETRIES.inc()
+                    logger.warning("Повтор запроса к модели через %.2f с (попытка %s): %r", pause, attempt + 2, exc)
+                    time.sleep(pause)
+                    attempt += 1
+                    continue
+                self._record_latency(time.perf_counter() - started)
+                return result
+        finally:
+            INFERENCE_CALL_ATTEMPTS.observe(attempt + 1)
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from conversation_utils import BotConfig, ChatMessage
+from metrics import RESPONSE_CACHE_HITS, RESPONSE_CACHE_MISSES
+
+
+class ResponseCache:
+    # LRU-кэш ответов модели с ограниченным временем жизни записей
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._max_entries = max_entries
+        self._ttl = ttl_seconds
+        self._entries: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+        # Кэш используется и из пула потоков (синхронный путь), поэтому защищаем его блокировкой
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _now(self) -> float:
+        return time.time()
+
+    # Ключ учитывает нормализованную историю, модель и параметры генерации
+    @staticmethod
+    def make_key(messages: List[ChatMessage], config: BotConfig) -> str:
+        normalized = [
+            [msg["role"], " ".join(msg["content"].split()).casefold()]
+            for msg in messages
+        ]
+        payload = json.dumps(
+            {
+                "model": config.model_name,
+                "messages": normalized,
+                "max_tokens": config.max_new_tokens,
+                "temperature": config.temperature,
+                "top_p": config.top_p,
+            },
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None or (self._ttl > 0 and item[0] < self._now()):
+                if item is not None:
+                    del self._entries[key]
+                self.misses += 1
+                RESPONSE_CACHE_MISSES.inc()
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            RESPONSE_CACHE_HITS.inc()
+            return item[1]
+
+    def put(self, key: str, response: str) -> None:
+        with self._lock:
+            self._entries[key] = (self._now() + self._ttl, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    # Счётчики попаданий и промахов для мониторинга
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+# Кэшировать можно только детерминированные ответы или (по явному разрешению) первые реплики без истории
+def is_cacheable(messages: List[ChatMessage], config: BotConfig) -> bool:
+    if config.response_cache_size <= 0:
+        return False
+    if config.temperature == 0:
+        return True
+    first_turn = len(messages) == 2 and messages[0]["role"] == "system"
+    return config.response_cache_first_turns and first_turn
@@ -0,0 +1,279 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import signal
+import socket
+from dataclasses import replace
+from typing import Any, Callable, List, Optional, Tuple
+
+from conversation_utils import BotConfig
+
+logger = logging.getLogger(__name__)
+
+# Длина кадра в канале к процессу-обработчику: 4 байта big-endian, затем JSON с Update
+FRAME_HEADER = 4
+# Сколько секунд long polling ждёт новых обновлений в одном запросе getUpdates
+POLL_TIMEOUT = 10
+
+
+# Ключ маршрутизации: автор обновления (он же effective_user в обработчиках), иначе чат или номер обновления
+def routing_key(data: dict) -> int:
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from")
+        if isinstance(user, dict) and "id" in user:
+            return int(user["id"])
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return int(chat["id"])
+    return int(data.get("update_id", 0))
+
+
+class WorkerPool:
+    # Процессы-обработчики и локальные каналы к ним. Обновления пользователя всегда попадают
+    # в один и тот же процесс, поэтому его ConversationManager остаётся единственным владельцем истории
+    def __init__(self, config: BotConfig):
+        self._config = config
+        self._processes: List[multiprocessing.Process] = []
+        self._sockets: List[socket.socket] = []
+        self._writers: List[asyncio.StreamWriter] = []
+        self._locks: List[asyncio.Lock] = []
+
+    def __len__(self) -> int:
+        return len(self._processes)
+
+    # Процессы создаются через fork до запуска event loop супервизора, чтобы не наследовать его потоки и сокеты
+    def start(self) -> None:
+        context = multiprocessing.get_context("fork")
+        for index in range(self._config.workers):
+            parent_sock, child_sock = socket.socketpair()
+            # Ребёнок наследует и родительские концы каналов: их нужно закрыть, иначе закрытие канала
+            # супервизором не дойдёт до процессов как конец потока
+            process = context.Process(
+                target=_worker_main,
+                args=(index, child_sock, self._config, self._sockets + [parent_sock]),
+                name=f"bot-worker-{index}",
+            )
+            process.start()
+            child_sock.close()
+            self._processes.append(process)
+            self._sockets.append(parent_sock)
+        logger.info("Запущено процессов-обработчиков: %s.", len(self._processes))
+
+    async def connect(self) -> None:
+        for sock in self._sockets:
+            _, writer = await asyncio.open_unix_connection(sock=sock)
+            self._writers.append(writer)
+            self._locks.append(asyncio.Lock())
+
+    # hash(int) детерминирован (не зависит от PYTHONHASHSEED), поэтому пользователь не переезжает между процессами
+    def route(self, user_id: int) -> int:
+        return hash(user_id) % len(self._writers)
+
+    async def send(self, user_id: int, data: dict) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        index = self.route(user_id)
+        # В Python 3.10 одновременные drain() одного потока запрещены, поэтому запись в канал сериализуем
+        async with self._locks[index]:
+            self._writers[index].write(len(body).to_bytes(FRAME_HEADER, "big") + body)
+            await self._writers[index].drain()
+
+    def dead_workers(self) -> List[str]:
+        return [process.name for process in self._processes if not process.is_alive()]
+
+    # Закрытый канал - сигнал процессу-обработчику доработать принятые обновления и завершиться
+    async def close(self) -> None:
+        for writer in self._writers:
+            writer.close()
+        await asyncio.gather(*(writer.wait_closed() for writer in self._writers), return_exceptions=True)
+
+    def join(self, timeout: float) -> None:
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("Процесс %s не завершился за %s с, останавливаю принудительно.", process.name, timeout)
+                # SIGTERM обработчики игнорируют
+                process.kill()
+                process.join()
+
+
+# Точка входа процесса-обработчика: обычное приложение бота, обновления которого приходят из канала супервизора
+def _worker_main(index: int, sock: socket.socket, config: BotConfig, inherited: List[socket.socket]) -> None:
+    # Сигнал группе процессов (Ctrl+C, systemd KillMode=control-group) приходит и обработчикам. Останавливает их
+    # только супервизор, закрывая канал: иначе обновления, уже пересланные, но не прочитанные из канала, потерялись бы
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, signal.SIG_IGN)
+    for parent_sock in inherited:
+        parent_sock.close()
+
+    import llm_bot
+    from app_runner import run_application
+
+    # У каждого процесса свой эндпоинт метрик: metrics_port + номер процесса
+    if config.metrics_port > 0:
+        config = replace(config, metrics_port=config.metrics_port + index)
+    application = llm_bot.create_application(config)
+
+    async def start_reader(stop_event: asyncio.Event) -> Callable[[], None]:
+        task = asyncio.create_task(_read_updates(application, sock, stop_event))
+
+        # Событие остановки выставляет сам читатель, дочитав канал до конца. Прерываем его,
+        # только если приложение останавливается по другой причине (ошибка при запуске)
+        def stop_reader() -> None:
+            if not task.done():
+                task.cancel()
+
+        return stop_reader
+
+    logger.info("Процесс-обработчик %s готов.", index)
+    asyncio.run(run_application(application, config, start_reader, handle_signals=False))
+    llm_bot.INFERENCE_EXECUTOR.shutdown(wait=True)
+
+
+async def _read_updates(application: Any, sock: socket.socket, stop_event: asyncio.Event) -> None:
+    from telegram import Update
+
+    reader, _ = await asyncio.open_unix_connection(sock=sock)
+    try:
+        while True:
+            header = await reader.readexactly(FRAME_HEADER)
+            body = await reader.readexactly(int.from_bytes(header, "big"))
+            try:
+                update = Update.de_json(json.loads(body), application.bot)
+            except Exception as exc:
+                logger.warning("Некорректный Update от супервизора: %s", exc)
+                continue
+            await application.update_queue.put(update)
+    except asyncio.IncompleteReadError:
+        # Супервизор закрыл канал: новых обновлений не будет
+        pass
+    finally:
+        stop_event.set()
+
+
+# Приём обновлений через long polling: getUpdates вызывает только супервизор
+async def _poll_updates(bot: Any, pool: WorkerPool) -> None:
+    from telegram import Update
+    from telegram.error import TelegramError
+
+    await bot.delete_webhook()
+    offset: Optional[int] = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES)
+            except TelegramError as exc:
+                logger.warning("Ошибка getUpdates: %s", exc)
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                data = update.to_dict()
+                await pool.send(routing_key(data), data)
+                # Сдвигаем offset только после пересылки: непереданный остаток пачки Telegram пришлёт снова
+                offset = update.update_id + 1
+    finally:
+        # Telegram считает обновления доставленными, только когда следующий getUpdates придёт с большим offset.
+        # Без этого запроса после перезапуска вся последняя пачка пришла бы повторно (как в Updater._get_updates_cleanup)
+        if offset is not None:
+            try:
+                await bot.get_updates(offset=offset, timeout=0, limit=1, allowed_updates=Update.ALL_TYPES)
+            except TelegramError as exc:
+                logger.warning("Не удалось подтвердить обработанные обновления: %s", exc)
+
+
+# Приём обновлений через webhook: супервизор только читает JSON и пересылает его нужному процессу
+async def _start_webhook(bot: Any, pool: WorkerPool, config: BotConfig) -> Callable[[], None]:
+    import tornado.web
+    from telegram import Update
+    from tornado.httpserver import HTTPServer
+
+    from webhook_server import TelegramWebhookHandler
+
+    class FanOutWebhookHandler(TelegramWebhookHandler):
+        def initialize(self, pool: WorkerPool, secret: str) -> None:
+            self._pool = pool
+            self._secret = secret
+
+        def parse(self, data: Any) -> Tuple[int, dict]:
+            if not isinstance(data, dict):
+                raise ValueError("ожидался JSON-объект")
+            return routing_key(data), data
+
+        async def dispatch(self, item: Tuple[int, dict]) -> None:
+            await self._pool.send(*item)
+
+    if config.webhook_url:
+        await bot.set_webhook(
+            url=config.webhook_url.rstrip("/") + "/" + config.webhook_path.strip("/"),
+            secret_token=config.webhook_secret or None,
+            allowed_updates=Update.ALL_TYPES,
+        )
+
+    path = "/" + config.webhook_path.strip("/")
+    server = HTTPServer(
+        tornado.web.Application([(path, FanOutWebhookHandler, {"pool": pool, "secret": config.webhook_secret})])
+    )
+    server.listen(config.webhook_port, address=config.webhook_listen)
+    logger.info("Webhook-сервер супервизора слушает %s:%s.", config.webhook_listen, config.webhook_port)
+    return server.stop
+
+
+async def _supervise(pool: WorkerPool, config: BotConfig) -> None:
+    from telegram import Bot
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await pool.connect()
+    bot = Bot(config.telegram_token, base_url=config.telegram_api_url or "https://api.telegram.org/bot")
+    await bot.initialize()
+
+    poll_task: Optional[asyncio.Task] = None
+    stop_server: Optional[Callable[[], None]] = None
+    if config.update_mode == "webhook":
+        stop_server = await _start_webhook(bot, pool, config)
+    else:
+        poll_task = asyncio.create_task(_poll_updates(bot, pool))
+
+    try:
+        # Если процесс-обработчик упал, его пользователи остались без обслуживания: останавливаемся целиком
+        while not stop_event.is_set():
+            dead = pool.dead_workers()
+            if dead:
+                logger.error("Процессы-обработчики завершились: %s. Останавливаю супервизор.", ", ".join(dead))
+                break
+            if poll_task is not None and poll_task.done():
+                logger.error("Приём обновлений остановился: %s", poll_task.exception())
+                break
+            try:
+                await asyncio.wait_for(stop_event.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        if stop_server is not None:
+            stop_server()
+        if poll_task is not None:
+            poll_task.cancel()
+            await asyncio.gather(poll_task, return_exceptions=True)
+        await bot.shutdown()
+        logger.info("Останавливаю процессы-обработчики, дожидаюсь обработки принятых обновлений.")
+        await pool.close()
+
+
+# Режим нескольких процессов: супервизор принимает обновления и распределяет их по hash(user_id) % workers
+def run_supervisor(config: BotConfig) -> None:
+    if config.telegram_token == "YOUR_BOT_TOKEN" or not config.telegram_token:
+        raise RuntimeError("TELEGRAM_TOKEN не задан. Установите переменную окружения TELEGRAM_TOKEN.")
+
+    pool = WorkerPool(config)
+    pool.start()
+    try:
+        asyncio.run(_supervise(pool, config))
+    finally:
+        pool.join(config.webhook_drain_timeout + 5)
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+OPEN_TAG = "<think>"
+CLOSE_TAG = "</think>"
+
+
+class ThinkFilter:
+    # Пошагово вырезает блоки <think>...</think> из потока фрагментов ответа модели.
+    # Тег может быть разрезан между фрагментами: подозрительный хвост придерживается до следующего фрагмента.
+    # Незакрытый блок рассуждений в видимый текст не попадает
+    def __init__(self, max_visible: int = 0):
+        self.text = ""
+        self._inside = False
+        self._pending = ""
+        self._max_visible = max_visible
+        # Видимый ответ закончился: модель снова начала рассуждать после ответа или ответ упёрся в max_visible.
+        # Дальнейшую генерацию можно не ждать
+        self.answer_complete = False
+
+    # Принимает очередной фрагмент и возвращает новую видимую часть текста
+    def feed(self, chunk: str) -> str:
+        data = self._pending + chunk
+        self._pending = ""
+        visible = []
+        pos = 0
+        while True:
+            tag = CLOSE_TAG if self._inside else OPEN_TAG
+            index = data.find("<", pos)
+            # Теги ASCII, поэтому сравнение без учёта регистра не меняет длину и позиции в исходной строке
+            while index != -1 and data[index:index + len(tag)].lower() != tag:
+                if len(data) - index < len(tag) and tag.startswith(data[index:].lower()):
+                    break
+                index = data.find("<", index + 1)
+            if index == -1:
+                if not self._inside:
+                    visible.append(data[pos:])
+                break
+            if len(data) - index < len(tag):
+                # Начало тега в конце фрагмента: решим, что это, когда придёт продолжение
+                if not self._inside:
+                    visible.append(data[pos:index])
+                self._pending = data[index:]
+                break
+            if not self._inside:
+                visible.append(data[pos:index])
+                if (self.text + "".join(visible)).strip():
+                    self.answer_complete = True
+            self._inside = not self._inside
+            pos = index + len(tag)
+        return self._emit("".join(visible))
+
+    # Конец генерации: обрывок, так и не ставший тегом, - обычный текст, незакрытый блок рассуждений отбрасывается
+    def finish(self) -> str:
+        pending, self._pending = self._pending, ""
+        return self._emit("" if self._inside else pending)
+
+    def _emit(self, visible: str) -> str:
+        self.text += visible
+        if self._max_visible and len(self.text) >= self._max_visible:
+            self.answer_complete = True
+        return visible
+
+
+# Видимая часть готового ответа целиком
+def strip_think(text: str) -> str:
+    think = ThinkFilter()
+    think.feed(text)
+    think.finish()
+    return think.text.strip()
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import json
+import logging
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Коэффициенты по моделям; подбираются по настоящему токенайзеру скриптом benchmarks/calibrate_tokens.py
+DEFAULT_RATIOS_PATH = Path(__file__).with_name("token_ratios.json")
+
+
+class TokenEstimator:
+    # Быстрая оценка числа токенов без токенайзера: линейная модель по числу ASCII-символов,
+    # байт UTF-8 остальных символов (кириллица - 2 байта, эмодзи - 4) и слов
+    def __init__(
+        self,
+        ascii_ratio: float,
+        non_ascii_ratio: float,
+        word_ratio: float = 0.0,
+        intercept: float = 0.0,
+    ):
+        self.ascii_ratio = ascii_ratio
+        self.non_ascii_ratio = non_ascii_ratio
+        self.word_ratio = word_ratio
+        self.intercept = intercept
+
+    # Признаки текста считаются встроенными методами строк, без прохода по символам в Python
+    @staticmethod
+    def features(text: str) -> Tuple[int, int, int]:
+        words = len(text.split())
+        if text.isascii():
+            return len(text), 0, words
+        ascii_chars = len(text.encode("ascii", "ignore"))
+        return ascii_chars, len(text.encode("utf-8")) - ascii_chars, words
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        ascii_chars, non_ascii, words = self.features(text)
+        estimate = (
+            self.intercept
+            + self.ascii_ratio * ascii_chars
+            + self.non_ascii_ratio * non_ascii
+            + self.word_ratio * words
+        )
+        return max(int(round(estimate)), 1)
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "ascii_ratio": self.ascii_ratio,
+            "non_ascii_ratio": self.non_ascii_ratio,
+            "word_ratio": self.word_ratio,
+            "intercept": self.intercept,
+        }
+
+    # Берёт коэффициенты модели из файла калибровки, для неизвестной модели - коэффициенты по умолчанию
+    @classmethod
+    def load(cls, model_name: str = "", path: Optional[Path] = None) -> "TokenEstimator":
+        with open(path or DEFAULT_RATIOS_PATH, encoding="utf-8") as file:
+            data = json.load(file)
+
+        params = data["models"].get(model_name)
+        if params is None:
+            if model_name:
+                logger.warning("Нет калибровки токенов для %s, использую коэффициенты по умолчанию.", model_name)
+            params = data["default"]
+        elif not params.get("samples"):
+            # Начальные коэффициенты без калибровки: оценка может заметно расходиться с токенайзером
+            logger.warning(
+                "Коэффициенты оценки токенов для %s не откалиброваны, запустите benchmarks/calibrate_tokens.py.",
+                model_name,
+            )
+        return cls(
+            ascii_ratio=params["ascii_ratio"],
+            non_ascii_ratio=params["non_ascii_ratio"],
+            word_ratio=params.get("word_ratio", 0.0),
+            intercept=params.get("intercept", 0.0),
+        )
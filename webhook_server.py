@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from typing import Any, Callable
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from telegram import Update
+from telegram.ext import Application
+
+from app_runner import run_application
+from conversation_utils import BotConfig
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    # Принимает JSON с Update от Telegram (или от локального теста) и кладёт его в очередь приложения
+    def initialize(self, bot_app: Application, secret: str) -> None:
+        self._bot_app = bot_app
+        self._secret = secret
+
+    async def post(self) -> None:
+        if self._secret and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self._secret:
+            self.set_status(403)
+            return
+
+        try:
+            item = self.parse(json.loads(self.request.body))
+        except Exception as exc:
+            logger.warning("Некорректный Update во входящем webhook-запросе: %s", exc)
+            self.set_status(400)
+            return
+
+        await self.dispatch(item)
+        self.set_status(200)
+
+    # Разбор и передачу обновления переопределяет супервизор, который пересылает его процессам-обработчикам
+    def parse(self, data: Any) -> Any:
+        return Update.de_json(data, self._bot_app.bot)
+
+    async def dispatch(self, update: Any) -> None:
+        await self._bot_app.update_queue.put(update)
+
+
+# Собирает HTTP-приложение с обработчиком webhook по пути config.webhook_path
+def make_web_app(application: Application, config: BotConfig) -> tornado.web.Application:
+    path = "/" + config.webhook_path.strip("/")
+    return tornado.web.Application(
+        [(path, TelegramWebhookHandler, {"bot_app": application, "secret": config.webhook_secret})]
+    )
+
+
+# Запускает бота в режиме webhook и при остановке дожидается обработки уже принятых обновлений
+async def serve_webhook(application: Application, config: BotConfig) -> None:
+    async def start_server(stop_event: asyncio.Event) -> Callable[[], None]:
+        # Без публичного адреса webhook в Telegram не регистрируется: так сервер можно проверять локальными POST-запросами
+        if config.webhook_url:
+            await application.bot.set_webhook(
+                url=config.webhook_url.rstrip("/") + "/" + config.webhook_path.strip("/"),
+                secret_token=config.webhook_secret or None,
+                allowed_updates=Update.ALL_TYPES,
+            )
+
+        server = HTTPServer(make_web_app(application, config))
+        server.listen(config.webhook_port, address=config.webhook_listen)
+        logger.info("Webhook-сервер слушает %s:%s.", config.webhook_listen, config.webhook_port)
+        return server.stop
+
+    await run_application(application, config, start_server)